@@ -0,0 +1,61 @@
+'''
+Times scientific name cleaning (bis.Utils.clean_scientific_names) on a list of raw names shaped like SGCN state
+lists, with each name cleaned from scratch and with the memoized batch path, over both distinct and repeated names.
+
+    python benchmarks/bench_clean_scientific_names.py [--number-names 120000]
+'''
+import argparse
+import time
+
+from bispy import bis
+
+raw_names = [
+    "Ursus arctos horribilis",
+    "Lynx canadensis (Contiguous US DPS)",
+    "Bombus sp. 1",
+    "Plethodon sp. near welleri",
+    "Ambystoma x",
+    "Canis lupus ssp.",
+    "Etheostoma cf. spectabile",
+    "Family Unionidae",
+    "Notropis sp. cf. chihuahua",
+    "Pyrgulopsis n. sp. 3",
+    "Castor canadensis [Columbia Basin pop.]",
+    "Salvelinus confluentus?",
+    "Ceratina dupla/floridana",
+    "Bufo americanus & B. fowleri",
+    "MyotisÃ© lucifugus",
+    "Cicindela &amp; Habroscelimorpha"
+]
+
+
+def run(label, function, names):
+    start = time.perf_counter()
+    cleaned = function(names)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed / len(names) * 1e6:8.2f} us/name")
+    return cleaned
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number-names", type=int, default=120000)
+    args = parser.parse_args()
+
+    utils = bis.Utils()
+    repeated = [raw_names[i % len(raw_names)] for i in range(args.number_names)]
+    distinct = [f"{name} {i}" for i, name in enumerate(repeated)]
+
+    def unmemoized(names):
+        return [bis._clean_scientific_name.__wrapped__(n) for n in names]
+
+    for label, names in [("distinct", distinct), ("repeated", repeated)]:
+        bis._clean_scientific_name.cache_clear()
+        expected = run(f"{label}, each name cleaned from scratch", unmemoized, names)
+        bis._clean_scientific_name.cache_clear()
+        cleaned = run(f"{label}, clean_scientific_names", utils.clean_scientific_names, names)
+        assert cleaned == expected
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+'''
+Times packaging ITIS Solr documents with Itis.package_itis_docs, in this process and in worker processes, and checks
+that both give the same packaged documents. Documents are read from a saved ITIS Solr response, JSON array or JSON
+Lines file (as accepted by ItisLocalIndex.build) when one is given, and are otherwise generated with the same layout
+as ITIS Solr documents.
+
+    python benchmarks/bench_itis_packaging.py [--docs itis_docs.json] [--number-docs 20000] [--max-workers 4]
+'''
+import argparse
+import copy
+import json
+import random
+import time
+
+from bispy import itis
+
+
+def make_doc(tsn, rnd):
+    def attribute(number_parts):
+        return "$".join([""] + [f"value {tsn} {k}" for k in range(number_parts)] + [""])
+
+    doc = {
+        "tsn": str(tsn),
+        "nameWOInd": f"Genus species{tsn}",
+        "nameWInd": f"Genus species{tsn}",
+        "usage": rnd.choice(["valid", "accepted", "invalid", "not accepted"]),
+        "acceptedTSN": [str(tsn + 1)],
+        "rank": "Species",
+        "createDate": "1996-06-13 14:51:08",
+        "updateDate": "2011-01-27 00:00:00",
+        "hierarchicalSort": "x",
+        "hierarchyTSN": ["$202423$914154$914156$"],
+        "hierarchySoFarWRanks": [
+            f"{tsn}:$Kingdom:Animalia$Phylum:Chordata$Class:Mammalia$Genus:Genus$Species:Genus species{tsn}$"
+        ],
+        "hierarchySoFar": [f"{tsn}:$Animalia$Chordata$Mammalia$Genus$Genus species{tsn}$"]
+    }
+    optional_attributes = {
+        "geographicDivision": 2,
+        "jurisdiction": 3,
+        "expert": 6,
+        "publication": 7,
+        "otherSource": 9,
+        "comment": 5
+    }
+    for name, number_parts in optional_attributes.items():
+        if rnd.random() < 0.7:
+            doc[name] = [attribute(number_parts) for i in range(rnd.randint(1, 3))]
+    if rnd.random() < 0.7:
+        doc["vernacular"] = [f"$common name {k}$English$N$" for k in range(rnd.randint(1, 3))]
+
+    return doc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", help="file of ITIS Solr documents to package instead of generated documents")
+    parser.add_argument("--number-docs", type=int, default=20000)
+    parser.add_argument("--max-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.docs is not None:
+        docs = list(itis.ItisLocalIndex(":memory:")._read_docs(args.docs))
+    else:
+        rnd = random.Random(7)
+        docs = [make_doc(tsn, rnd) for tsn in range(1, args.number_docs + 1)]
+
+    itis_search = itis.Itis()
+    runs = [
+        ("package_itis_docs, this process", None),
+        (f"package_itis_docs, {args.max_workers} worker processes", args.max_workers)
+    ]
+
+    results = list()
+    for label, max_workers in runs:
+        # package_itis_json changes the docs it is given, so every run gets its own copy
+        run_docs = copy.deepcopy(docs)
+        start = time.perf_counter()
+        results.append(itis_search.package_itis_docs(run_docs, max_workers=max_workers))
+        elapsed = time.perf_counter() - start
+        print(f"{label:<45} {elapsed / len(docs) * 1e6:8.2f} us/doc")
+
+    assert all(json.dumps(r) == json.dumps(results[0]) for r in results[1:])
+
+
+if __name__ == "__main__":
+    main()
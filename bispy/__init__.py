@@ -5,6 +5,7 @@ import pkg_resources  # part of setuptools
 
 # Import bis objects
 from . import bis
+from . import transport
 from . import aws
 from . import itis
 from . import worms
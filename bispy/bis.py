@@ -1,18 +1,82 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import queue
 import random
+import threading
 import os
+import shutil
+import tempfile
 import json
 from genson import SchemaBuilder
 import pkg_resources
 import sciencebasepy
 import re
+from functools import lru_cache
 from ftfy import fix_text
 
+# Precompiled patterns and lookup values used in cleaning scientific names
+_digits_pattern = re.compile(r'\d+')
+_enclosed_pattern = re.compile('[\(\[\"].*?[\)\]\"]')
+_remove_pattern = re.compile(r'|'.join(map(re.escape, ["?", "Family "])))
+
+# Particular words are used to describe variations or nuances in taxonomy but are not able to be used in
+# matching names at this time
+_after_chars = ["(", " AND ", "/", " & ", " vs ", " undescribed ", ",", " formerly ", " near ", "Columbia Basin",
+                "Puget Trough", " n.sp. ", " n. ", " sp. ", " sp ", " pop. ", " spp. ", " cf. ", " ] "]
+_after_chars_pattern = re.compile(r'|'.join(map(re.escape, _after_chars)))
+
+
+@lru_cache(maxsize=65536)
+def _clean_scientific_name(nameString):
+    # Fix encoding translation issues; plain printable ASCII without HTML entities comes back from ftfy unchanged
+    if not (nameString.isascii() and nameString.isprintable() and "&" not in nameString):
+        nameString = fix_text(nameString)
+
+    # Remove digits, we can't work with these right now
+    nameString = _digits_pattern.sub('', nameString)
+
+    # Get rid of strings in parentheses and brackets (these might need to be revisited eventually, but we can
+    # often find a match without this information)
+    nameString = _enclosed_pattern.sub("", nameString)
+    nameString = ' '.join(nameString.split())
+
+    # Remove some specific substrings
+    nameString = _remove_pattern.sub('', nameString)
+
+    # Change uses of "subsp." to "ssp." for ITIS
+    nameString = nameString.replace("subsp.", "ssp.")
+
+    # Truncate at the earliest of the afterChars substrings. Truncating leaves a trailing space that can complete a
+    # new match (e.g. "sp(" becoming "sp "), so we keep cutting at the first match until there is nothing left.
+    nameString = nameString + " "
+    match = _after_chars_pattern.search(nameString)
+    while match is not None:
+        nameString = nameString[:match.start()] + " "
+        match = _after_chars_pattern.search(nameString)
+
+    nameString = nameString.strip()
+
+    # Deal with cases where an "_" was used
+    if nameString.find("_") != -1:
+        nameString = ' '.join(nameString.split("_"))
+
+    # Check to make sure there is actually a subspecies or variety name supplied
+    if len(nameString) > 0:
+        namesList = nameString.split(" ")
+        if namesList[-1] in ["ssp.", "var."]:
+            nameString = ' '.join(namesList[:-1])
+
+    # Take care of capitalizing final cross indicator
+    nameString = nameString.replace(" x ", " X ")
+
+    return nameString.capitalize()
+
+
 class Sciencebase:
     def __init__(self):
         self.sbpy = sciencebasepy.SbSession()
-    
+
     def collection_items(self, collection_id, fields="id"):
         '''
         Loops through specified ScienceBase collection to return all items in a list with a set of fields. This
@@ -22,18 +86,107 @@ class Sciencebase:
         :param fields: str, comma delimited string of ScienceBase Item fields to return
         :return: List of the ScienceBase child items under parent item
         '''
-        filter = f"parentId={collection_id}" 
-        params = {"max":100, "filter":filter, "fields": fields}
+        return list(self.iter_collection_items(collection_id, fields=fields, page_size=100))
+
+    def iter_collection_items(self, collection_id, fields="id", page_size=1000, partitions=None, max_workers=4):
+        '''
+        Generator version of collection_items that yields items as each page of results arrives. To get past the
+        100,000 record ceiling on paging through a single search, the collection can be split into partitions (e.g.
+        from date_range_partitions) that are each paged through separately and fetched concurrently.
+
+        :param collection_id: str, ScienceBase parent item ID
+        :param fields: str, comma delimited string of ScienceBase Item fields to return
+        :param page_size: number of items to request per page
+        :param partitions: list of additional ScienceBase filter strings that split the collection into disjoint sets
+        :param max_workers: number of partitions to fetch concurrently
+        :return: generator of the ScienceBase child items under parent item
+        '''
+        if partitions is None:
+            for page in self._collection_pages(collection_id, fields, page_size):
+                yield from page
+            return
+
+        # The queue is bounded so that fetching stays only a few pages ahead of the consumer, and the stop event lets
+        # workers give up when the generator is closed before every partition has been read
+        pages = queue.Queue(maxsize=2 * max_workers)
+        stop = threading.Event()
+
+        def put_page(page):
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch_partition(partition):
+            try:
+                if stop.is_set():
+                    return
+                for page in self._collection_pages(collection_id, fields, page_size, partition):
+                    if not put_page(page):
+                        return
+            finally:
+                put_page(None)
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = [executor.submit(fetch_partition, partition) for partition in partitions]
+
+            remaining = len(futures)
+            while remaining > 0:
+                page = pages.get()
+                if page is None:
+                    remaining -= 1
+                else:
+                    yield from page
+
+            # Raise any errors encountered in fetching partitions
+            for future in futures:
+                future.result()
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
+
+    def _collection_pages(self, collection_id, fields, page_size, partition=None):
+        params = {"max": page_size, "filter0": f"parentId={collection_id}", "fields": fields}
+        if partition is not None:
+            params["filter1"] = partition
 
-        item_list = list()
-        
         items = self.sbpy.find_items(params)
 
         while items and 'items' in items:
-            item_list.extend(items['items'])
+            yield items['items']
             items = self.sbpy.next(items)
 
-        return item_list
+    def date_range_partitions(self, start_date, end_date, number_partitions, date_type="lastUpdated"):
+        '''
+        Splits a span of dates into ScienceBase dateRange filters for use as partitions in iter_collection_items.
+
+        :param start_date: datetime.date for the start of the first partition
+        :param end_date: datetime.date for the end of the last partition (inclusive)
+        :param number_partitions: number of date ranges to split the span into
+        :param date_type: ScienceBase item date type to filter on
+        :return: list of ScienceBase filter strings covering the span without overlapping
+        '''
+        total_days = (end_date - start_date).days + 1
+        number_partitions = max(1, min(number_partitions, total_days))
+
+        partitions = list()
+        for i in range(number_partitions):
+            range_start = start_date + timedelta(days=total_days * i // number_partitions)
+            range_end = start_date + timedelta(days=total_days * (i + 1) // number_partitions - 1)
+            date_range = {
+                "dateType": date_type,
+                "choice": "range",
+                "start": range_start.isoformat(),
+                "end": range_end.isoformat()
+            }
+            partitions.append(f"dateRange={json.dumps(date_range)}")
+
+        return partitions
+
 
 class Utils:
     def __init__(self):
@@ -48,15 +201,22 @@ class Utils:
         }
         return packaged_stub
 
-    def doc_cache(self, cache_path, cache_data=None, return_sample=True):
+    def doc_cache(self, cache_path, cache_data=None, return_sample=True, jsonl=False, append=False):
         '''
         Caches a list of dictionaries as a JSON document array to a specified relative path and returns a sample.
 
         :param cache_path: relative file path to write to; will overwrite if it exists
         :param cache_data: list of dictionaries to cache as JSON document array
         :param return_sample: return a random sample for verification
+        :param jsonl: cache as JSON Lines (one document per line) instead; cache_data can then be any iterable or
+        generator of dictionaries, and documents are written and sampled in a single streaming pass
+        :param append: with jsonl, add documents to the end of an existing cache instead of overwriting it; the
+        existing documents are not read again, so the sample returned is from the appended documents
         :return:
         '''
+        if jsonl:
+            return self._doc_cache_jsonl(cache_path, cache_data, return_sample, append)
+
         if cache_data is not None:
             if not isinstance(cache_data, list):
                 return "Error: cache_data needs to be a list of dictionaries"
@@ -98,13 +258,125 @@ class Utils:
                 f"Document Number {doc_number}": the_cache[doc_number]
             }
 
-    def generate_json_schema(self, data):
+    def _doc_cache_jsonl(self, cache_path, cache_data, return_sample, append):
+        count = 0
+        doc_number = None
+        sample = None
+
+        if cache_data is not None:
+            # Documents are written to a temporary file first so that a failed write leaves an existing cache
+            # untouched. The temporary file then either replaces the cache or, when appending, is added to the end of
+            # it, so that appending never has to read or copy the documents already in the cache.
+            try:
+                handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_path)), suffix=".tmp")
+                try:
+                    with os.fdopen(handle, "w") as f:
+                        for doc in cache_data:
+                            if not isinstance(doc, dict):
+                                return "Error: cache_data needs to be an iterable of dictionaries"
+                            f.write(json.dumps(doc))
+                            f.write("\n")
+                            if return_sample:
+                                if random.randint(0, count) == 0:
+                                    doc_number, sample = count, doc
+                            count += 1
+                    if count == 0:
+                        return "Error: cache_data needs to contain at least one dictionary"
+
+                    if append and os.path.exists(cache_path):
+                        with open(temp_path, "rb") as segment, open(cache_path, "ab+") as cache:
+                            # Make sure the first new document starts on its own line
+                            if cache.seek(0, os.SEEK_END) > 0:
+                                cache.seek(-1, os.SEEK_END)
+                                if cache.read(1) != b"\n":
+                                    cache.write(b"\n")
+                            shutil.copyfileobj(segment, cache)
+                    else:
+                        os.replace(temp_path, cache_path)
+                finally:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+            except Exception as e:
+                return f"Error: {e}"
+
+            if return_sample and append:
+                return {
+                    "Doc Cache File": cache_path,
+                    "Number of Documents Appended": count,
+                    f"Appended Document Number {doc_number}": sample
+                }
+
+        if not return_sample:
+            return "Success"
+
+        if cache_data is None:
+            if not os.path.exists(cache_path):
+                return "Error: file does not exist"
+
+            try:
+                with open(cache_path, "r") as f:
+                    for line in f:
+                        if line.strip():
+                            if random.randint(0, count) == 0:
+                                doc_number, sample = count, line
+                            count += 1
+            except Exception as e:
+                return f"Error: {e}"
+
+            if count == 0:
+                return "Error: file does not contain any documents"
+
+        if isinstance(sample, str):
+            try:
+                sample = json.loads(sample)
+            except Exception as e:
+                return f"Error: {e}"
+
+        if not isinstance(sample, dict):
+            return "Error: file does not contain JSON objects (documents)"
+
+        return {
+            "Doc Cache File": cache_path,
+            "Number of Documents in Cache": count,
+            f"Document Number {doc_number}": sample
+        }
+
+    def iter_doc_cache(self, cache_path):
+        '''
+        Lazily reads documents from a cache written by doc_cache. JSON Lines caches are read one line at a time so
+        that only the current document is held in memory; JSON document array caches have to be loaded in full.
+
+        :param cache_path: relative file path of the cache to read
+        :return: generator of documents (dictionaries)
+        '''
+        with open(cache_path, "r") as f:
+            first_char = f.read(1)
+            while first_char.isspace():
+                first_char = f.read(1)
+            f.seek(0)
+
+            if first_char == "[":
+                for doc in json.loads(f.read()):
+                    yield doc
+            else:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def generate_json_schema(self, data, sample_size=None, max_workers=None, return_coverage=False):
         '''
         Uses the genson package to introspect json type data and generate the skeleton of a JSON Schema document
         (Draft 6) for further documentation.
 
+        Properties whose values have the same structure (types, nested keys and array item types) only contribute to
+        the schema once, so they are deduplicated by their shape before being handed to genson.
+
         :param data: must be one of the following - python dictionary object, python list of dictionaries, json string
         that can be loaded to a dictionary or list of dictionaries
+        :param sample_size: if set, only a random sample of this many records is introspected
+        :param max_workers: if set to 1 or more, partial schemas are built in this many worker processes and merged
+        :param return_coverage: return a dictionary with the schema and counts of records and distinct record shapes
+        seen instead of only the schema
         :return: json string containing the generated json schema skeleton
         '''
         if isinstance(data, str):
@@ -119,29 +391,72 @@ class Utils:
         if not isinstance(data[0], dict):
             return "Error: your list must contain a dictionary type object"
 
+        number_records = len(data)
+        if sample_size is not None and sample_size < number_records:
+            data = random.sample(data, sample_size)
+
         try:
-            builder = SchemaBuilder()
-            builder.add_schema({"type": "object", "properties": {}})
+            record_shapes = set()
+            properties = dict()
             for r in data:
+                record_shape = list()
                 for k, v in r.items():
-                    builder.add_object({k: v})
+                    property_shape = (k, _json_shape(v))
+                    record_shape.append(property_shape)
+                    if property_shape not in properties:
+                        properties[property_shape] = {k: v}
+                record_shapes.add(tuple(record_shape))
+
+            builder = SchemaBuilder()
+            builder.add_schema({"type": "object", "properties": {}})
+            # A pool is only worth starting when there is at least one property to hand to at least one worker
+            if max_workers is None or max_workers < 1 or len(properties) == 0:
+                for obj in properties.values():
+                    builder.add_object(obj)
+            else:
+                # Each property is built entirely within one partial schema because genson drops empty "required"
+                # lists from the schemas it outputs, which would otherwise be lost when merging nested objects
+                objects_by_property = dict()
+                for (k, shape), obj in properties.items():
+                    objects_by_property.setdefault(k, list()).append(obj)
+
+                chunks = [list() for i in range(min(max_workers, len(objects_by_property)))]
+                chunk_size = -(-len(properties) // len(chunks))
+                chunk_index = 0
+                for objects in objects_by_property.values():
+                    if len(chunks[chunk_index]) >= chunk_size and chunk_index < len(chunks) - 1:
+                        chunk_index += 1
+                    chunks[chunk_index].extend(objects)
+
+                with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                    for schema in executor.map(_partial_json_schema, chunks):
+                        # Properties are never required at the top level when more than one property is present
+                        if len(chunks) > 1:
+                            schema.pop("required", None)
+                        builder.add_schema(schema)
         except Exception as e:
             return f"Error: {e}"
 
-        return builder.to_json()
+        if not return_coverage:
+            return builder.to_json()
+
+        return {
+            "JSON Schema": builder.to_json(),
+            "Number of Records": number_records,
+            "Number of Records Sampled": len(data),
+            "Number of Distinct Shapes": len(record_shapes)
+        }
 
     def alter_keys(self, item, mappings, layer=None, key=None):
-        if layer is None:
-            layer = item
-        if isinstance(item, dict):
-            for k, v in item.items():
-                self.alter_keys(v, mappings, item, k)
-        if isinstance(key, str):
-            for orig, new in mappings.items():
-                if orig in layer.keys():
-                    layer[new] = layer.pop(orig)
-
-        return layer
+        '''
+        Renames keys in a dictionary and any nested dictionaries from alias names to new names, altering the item in
+        place. The layer and key parameters are no longer used and are only kept for backwards compatibility.
+
+        :param item: dictionary to alter
+        :param mappings: dictionary of alias (original) key names to new key names
+        :return: the altered item
+        '''
+        return RecordMapper(mappings=mappings).map_record(item)
 
     def integrate_recordset(self, recordset, target_properties=None):
         '''
@@ -155,111 +470,223 @@ class Utils:
         :param target_properties:
         :return: recordset with applicable property names registered as aliases mapped to target/preferred names
         '''
-
-        path = 'resources/common_properties.json'
-        filepath = pkg_resources.resource_filename(__name__, path)
-        with open(filepath, 'r') as f:
-            common_properties = json.loads(f.read())
-            f.close()
-
-        # This is completely stupid, but I can't get my head around a combination of list and dict
-        # comprehension to do this more elegantly right now
-        mappings = dict()
-        for k, v in common_properties["definitions"].items():
-            if target_properties is None:
-                if "aliases" in common_properties["definitions"][k]:
-                    for alias in common_properties["definitions"][k]["aliases"]:
-                        mappings[alias] = k
-            else:
-                if "aliases" in common_properties["definitions"][k] and k in target_properties:
-                    for alias in common_properties["definitions"][k]["aliases"]:
-                        mappings[alias] = k
-
         if isinstance(recordset, dict):
             recordset = [recordset]
 
-        new_recordset = list()
-        for record in recordset:
-            new_recordset.append(self.alter_keys(record, mappings))
-
-        return recordset
+        return list(RecordMapper(target_properties).map_many(recordset))
 
     def clean_scientific_name(self, scientificname):
         if isinstance(scientificname, float):
             return None
 
-        nameString = str(scientificname)
+        return _clean_scientific_name(str(scientificname))
 
-        # Fix encoding translation issues
-        nameString = fix_text(nameString)
+    def clean_scientific_names(self, scientificnames):
+        '''
+        Batch version of clean_scientific_name for working through large lists of raw names (e.g., SGCN state lists).
+        Cleaning runs through precompiled patterns and a bounded memo, so repeated raw strings are only processed once.
+
+        :param scientificnames: iterable of raw scientific name strings
+        :return: list of cleaned names in the same order as the input (None for float/NaN values)
+        '''
+        return [self.clean_scientific_name(n) for n in scientificnames]
+
+    def clean_scientific_name_series(self, scientificnames):
+        '''
+        Pandas variant of clean_scientific_names for name columns in data frames.
+
+        :param scientificnames: pandas Series of raw scientific name strings
+        :return: pandas Series of cleaned names with the same index as the input
+        '''
+        return scientificnames.map(self.clean_scientific_name)
 
-        # Remove digits, we can't work with these right now
-        nameString = re.sub(r'\d+', '', nameString)
 
-        # Get rid of strings in parentheses and brackets (these might need to be revisited eventually, but we can
-        # often find a match without this information)
-        nameString = re.sub('[\(\[\"].*?[\)\]\"]', "", nameString)
-        nameString = ' '.join(nameString.split())
+@lru_cache(maxsize=1)
+def _common_properties():
+    path = 'resources/common_properties.json'
+    filepath = pkg_resources.resource_filename(__name__, path)
+    with open(filepath, 'r') as f:
+        return json.loads(f.read())
 
-        # Remove some specific substrings
-        removeList = ["?", "Family "]
-        nameString = re.sub(r'|'.join(map(re.escape, removeList)), '', nameString)
 
-        # Change uses of "subsp." to "ssp." for ITIS
-        nameString = nameString.replace("subsp.", "ssp.")
+@lru_cache(maxsize=None)
+def _alias_mappings(target_properties):
+    mappings = dict()
+    for k, v in _common_properties()["definitions"].items():
+        if "aliases" in v and (target_properties is None or k in target_properties):
+            for alias in v["aliases"]:
+                mappings[alias] = k
 
-        # Particular words are used to describe variations or nuances in taxonomy but are not able to be used in
-        # matching names at this time
-        afterChars = ["(", " AND ", "/", " & ", " vs ", " undescribed ", ",", " formerly ", " near ", "Columbia Basin",
-                      "Puget Trough", " n.sp. ", " n. ", " sp. ", " sp ", " pop. ", " spp. ", " cf. ", " ] "]
-        nameString = nameString + " "
-        while any(substring in nameString for substring in afterChars):
-            for substring in afterChars:
-                nameString = nameString.split(substring, 1)[0]
-                nameString = nameString + " "
+    return mappings
 
-        nameString = nameString.strip()
 
-        # Deal with cases where an "_" was used
-        if nameString.find("_") != -1:
-            nameString = ' '.join(nameString.split("_"))
+class RecordMapper:
+    def __init__(self, target_properties=None, mappings=None):
+        '''
+        Maps alias property names to target/preferred property names from the "common_properties" JSON Schema
+        definitions. The alias table is read once per process and the mappings are cached for each set of
+        target_properties, so a mapper is cheap to create and can be reused across any number of records.
+
+        :param target_properties: list of preferred property names to map to; all properties with aliases if None
+        :param mappings: explicit dictionary of alias names to new names to use instead of common_properties
+        '''
+        if mappings is None:
+            if target_properties is not None:
+                target_properties = tuple(sorted(set(target_properties)))
+            mappings = _alias_mappings(target_properties)
+
+        self.mappings = mappings
+        self._order = {alias: index for index, alias in enumerate(mappings)}
 
-        # Check to make sure there is actually a subspecies or variety name supplied
-        if len(nameString) > 0:
-            namesList = nameString.split(" ")
-            if namesList[-1] in ["ssp.", "var."]:
-                nameString = ' '.join(namesList[:-1])
+    def map_record(self, record):
+        '''
+        Renames alias keys in a dictionary and all dictionaries nested within it in a single pass, altering the record
+        in place. Renamed keys are moved to the end of their dictionary in mapping order.
+
+        :param record: dictionary to map
+        :return: the mapped record
+        '''
+        if not isinstance(record, dict):
+            return record
 
-        # Take care of capitalizing final cross indicator
-        nameString = nameString.replace(" x ", " X ")
+        for v in record.values():
+            if isinstance(v, dict):
+                self.map_record(v)
 
-        return nameString.capitalize()
+        aliases = [k for k in record if k in self._order]
+        if aliases:
+            aliases.sort(key=self._order.__getitem__)
+            for alias in aliases:
+                record[self.mappings[alias]] = record.pop(alias)
+
+        return record
+
+    def map_many(self, recordset):
+        '''
+        Lazily maps an iterable of records, yielding each one as it is mapped so that large recordsets or generators
+        do not need to be held in memory.
+
+        :param recordset: iterable of dictionaries
+        :return: generator of mapped records
+        '''
+        for record in recordset:
+            yield self.map_record(record)
+
+
+def _json_shape(value):
+    # Structural signature of a JSON value; values with the same signature produce the same genson schema
+    if isinstance(value, dict):
+        return dict, tuple((k, _json_shape(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return list, frozenset(_json_shape(v) for v in value)
+    return type(value)
+
+
+def _partial_json_schema(objects):
+    builder = SchemaBuilder()
+    builder.add_schema({"type": "object", "properties": {}})
+    for obj in objects:
+        builder.add_object(obj)
+    return builder.to_schema()
+
+
+def _count_chunk(chunk, missing):
+    if isinstance(chunk, str):
+        chunk = Utils().iter_doc_cache(chunk)
+    return AttributeValueCount(chunk, missing=missing)
 
 
 class AttributeValueCount:
-    def __init__(self, iterable, *, missing=None):
+    def __init__(self, iterable=(), *, missing=None):
+        '''
+        Counts the values found for every attribute (key) across a set of records. Only the values actually present
+        are counted as records are added; the number of records missing each attribute is derived from the total
+        length when the counts are read, so records with few of many known attributes stay cheap to count.
+
+        :param iterable: iterable of dictionaries to count
+        :param missing: value used to count records that do not contain an attribute
+        '''
         self._missing = missing
         self.length = 0
         self._counts = {}
         self.update(iterable)
 
+    @classmethod
+    def from_chunks(cls, chunks, *, missing=None, max_workers=None):
+        '''
+        Counts chunks of records in separate worker processes and merges the results. Chunks can be lists of
+        dictionaries or paths to doc caches (e.g. a sharded set of JSON Lines files written with Utils.doc_cache).
+
+        :param chunks: iterable of chunks, each a list of dictionaries or a doc cache file path
+        :param missing: value used to count records that do not contain an attribute
+        :param max_workers: number of worker processes; defaults to the number of processors on the machine
+        :return: AttributeValueCount with the combined counts of all chunks
+        '''
+        result = cls(missing=missing)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_count_chunk, chunk, missing) for chunk in chunks]
+            for future in futures:
+                result.merge(future.result())
+
+        return result
+
     def update(self, iterable):
-        categories = set(self._counts)
-        for length, element in enumerate(iterable, self.length):
-            categories.update(element)
-            for category in categories:
+        counts = self._counts
+        length = self.length
+        for element in iterable:
+            for category, value in element.items():
                 try:
-                    counter = self._counts[category]
+                    counts[category][value] += 1
                 except KeyError:
-                    self._counts[category] = counter = Counter({self._missing: length})
-                counter[element.get(category, self._missing)] += 1
-        self.length = length + 1
+                    counts[category] = Counter({value: 1})
+            length += 1
+        self.length = length
+
+    def update_columns(self, columns, length=None):
+        '''
+        Counts a batch of records laid out as columns, e.g. from DataFrame.to_dict("list") or a columnar file
+        reader. Records without a value for an attribute should hold the missing value in that column.
+
+        :param columns: dictionary of attribute name to a sequence of values, one per record in the batch
+        :param length: number of records in the batch; defaults to the length of the first column
+        '''
+        if length is None:
+            length = len(next(iter(columns.values()), ()))
+
+        for category, values in columns.items():
+            try:
+                self._counts[category].update(values)
+            except KeyError:
+                self._counts[category] = Counter(values)
+        self.length += length
+
+    def merge(self, other):
+        '''
+        Combines the counts from another AttributeValueCount, such as one built in a separate worker process.
+
+        :param other: AttributeValueCount using the same missing value
+        :return: self, with the counts of other added
+        '''
+        if other._missing != self._missing:
+            raise ValueError("Cannot merge AttributeValueCount objects with different missing values")
+
+        for category, counter in other._counts.items():
+            try:
+                self._counts[category].update(counter)
+            except KeyError:
+                self._counts[category] = Counter(counter)
+        self.length += other.length
+
+        return self
 
     def add(self, element):
         self.update([element])
 
     def __getitem__(self, key):
-        return self._counts[key]
+        counter = self._counts[key]
+        result = Counter({self._missing: self.length - sum(counter.values())})
+        result.update(counter)
+        return result
 
     def summary(self, key=None):
         if key is None:
@@ -267,5 +694,5 @@ class AttributeValueCount:
 
         return '-- {} --\n{}'.format(key, '\n'.join(
                 '\t {}: {}'.format(value, count)
-                for value, count in self._counts[key].items()
+                for value, count in self[key].items()
         ))
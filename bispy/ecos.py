@@ -1,18 +1,74 @@
-import requests
 import xmltodict
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer
 from . import bis
+from . import transport
+import json
+import sqlite3
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
+try:
+    from bs4.filter import ElementFilter
+except ImportError:
+    ElementFilter = None
+
 bis_utils = bis.Utils()
 
 
+def _ecos_region(name, attrs):
+    # Top level elements kept by the fast extraction path: the page title, the taxonomy section, table captions and
+    # tables
+    if name in ["title", "table"]:
+        return True
+    if name != "div" or attrs is None:
+        return False
+    css_class = attrs.get("class")
+    if isinstance(css_class, list):
+        css_class = " ".join(css_class)
+    return css_class in ["table-caption", "taxonomy new-row"]
+
+
+if ElementFilter is not None:
+    class _EcosRegionFilter(ElementFilter):
+        # Newer versions of Beautiful Soup only give SoupStrainer functions the tag name, so the attributes are
+        # checked through an ElementFilter instead
+        def allow_tag_creation(self, nsprefix, name, attrs):
+            return _ecos_region(name, attrs)
+
+        def allow_string_creation(self, string):
+            return False
+
+
 class Tess:
-    def __init__(self):
+    def __init__(self, session=None, local_index=None):
+        '''
+        :param session: optional Transport or requests.Session to send requests through instead of the shared default
+        transport
+        :param local_index: optional TessLocalIndex (or path to one built with bulk_export) to answer searches from
+        instead of querying the TESS service
+        '''
         self.description = 'Set of functions for working with the USFWS Threatened and Endangered Species System'
         self.tess_api_base = "https://ecos.fws.gov/ecp0/TessQuery?request=query&xquery=/SPECIES_DETAIL"
+        self.http = transport.get_transport(session)
+        if isinstance(local_index, str):
+            local_index = TessLocalIndex(local_index)
+        self.local_index = local_index
 
+    @transport.records_cache_status
     def search(self, criteria):
+        return transport.run_steps(self.http, self.search_steps(criteria))
+
+    async def search_async(self, criteria, client=None):
+        '''
+        Asyncio version of search.
+
+        :param client: optional httpx.AsyncClient to send requests through
+        :return: result structured the same as search
+        '''
+        return await transport.run_steps_async(self.http, self.search_steps(criteria), client)
+
+    def search_steps(self, criteria):
 
         tess_result = bis_utils.processing_metadata()
         tess_result["processing_metadata"]["status"] = "failure"
@@ -24,8 +80,17 @@ class Tess:
             tess_result["processing_metadata"]["api"] = f'{self.tess_api_base}[SCINAME="{criteria}"]'
             tess_result["parameters"]= {'Scientific Name': criteria}
 
+        if self.local_index is not None:
+            species_details = self.local_index.search(criteria)
+            if len(species_details) > 0:
+                tess_result["processing_metadata"]["status"] = "success"
+                tess_result["data"] = {
+                    "SPECIES_DETAIL": species_details[0] if len(species_details) == 1 else species_details
+                }
+            return tess_result
+
         # Query the TESS XQuery service
-        tess_response = requests.get(tess_result["processing_metadata"]["api"])
+        tess_response = yield tess_result["processing_metadata"]["api"]
 
         if tess_response.status_code != 200:
             tess_result["processing_metadata"]["status"] = "error"
@@ -44,9 +109,154 @@ class Tess:
 
         return tess_result
 
+    def bulk_export(self, local_index=None, source=None, batch_size=1000):
+        '''
+        Pulls the full SPECIES_DETAIL result set from TESS in one request and streams it into a local index, parsing
+        one species record at a time so that memory use stays flat no matter how large the export is.
+
+        :param local_index: TessLocalIndex or path to one; defaults to the index set on this Tess
+        :param source: optional path to a previously downloaded TESS XML export to read instead of the service
+        :param batch_size: number of species records to write to the index at a time
+        :return: number of species records indexed, replacing anything already in the index once the export has been
+        read in full
+        '''
+        if local_index is None:
+            local_index = self.local_index
+        elif isinstance(local_index, str):
+            local_index = TessLocalIndex(local_index)
+        if local_index is None:
+            raise ValueError("A local index is needed to save the export to")
+
+        # Records are loaded into a staging table so that the current index keeps answering searches until the
+        # export has been read in full, and is left as it was if the download or parsing fails
+        local_index.start_staging()
+        species_details = list()
+        counts = {"indexed": 0}
+
+        def collect(path, item):
+            if path[-1][0] == "SPECIES_DETAIL":
+                species_details.append(item)
+                if len(species_details) >= batch_size:
+                    counts["indexed"] += local_index.add(species_details, staging=True)
+                    species_details.clear()
+            return True
+
+        try:
+            if source is not None:
+                with open(source, "rb") as f:
+                    xmltodict.parse(f, item_depth=2, item_callback=collect, dict_constructor=dict)
+            else:
+                tess_response = self.http.get(self.tess_api_base, stream=True)
+                tess_response.raise_for_status()
+                if getattr(tess_response, "from_cache", None) is None:
+                    tess_response.raw.decode_content = True
+                    tess_stream = tess_response.raw
+                else:
+                    # Responses that go through a transport cache have already been read in full
+                    tess_stream = BytesIO(tess_response.content)
+                xmltodict.parse(tess_stream, item_depth=2, item_callback=collect, dict_constructor=dict)
+
+            counts["indexed"] += local_index.add(species_details, staging=True)
+        except:
+            local_index.discard_staging()
+            raise
+
+        local_index.swap_in_staging()
+
+        return counts["indexed"]
+
+
+class TessLocalIndex:
+    def __init__(self, index_path):
+        '''
+        SQLite index of TESS SPECIES_DETAIL records for answering Tess.search without calling the TESS service,
+        matching records on TSN or SCINAME the same way as the XQuery filters built by Tess.search.
+
+        :param index_path: path to the SQLite index file
+        '''
+        self.index_path = index_path
+        self.connection = sqlite3.connect(index_path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS tess_species (
+                tsn TEXT,
+                sciname TEXT,
+                species_detail TEXT
+            );
+            CREATE INDEX IF NOT EXISTS tess_species_tsn ON tess_species (tsn);
+            CREATE INDEX IF NOT EXISTS tess_species_sciname ON tess_species (sciname);
+        ''')
+        self.connection.commit()
+
+    def add(self, species_details, staging=False):
+        '''
+        :param species_details: list of SPECIES_DETAIL records as parsed by xmltodict
+        :param staging: add the records to the staging table set up with start_staging instead of the index
+        :return: number of records added
+        '''
+        self.connection.executemany(
+            f"INSERT INTO {'tess_species_staging' if staging else 'tess_species'} VALUES (?, ?, ?)",
+            [(self._normalize_tsn(d.get("TSN")), d.get("SCINAME"), json.dumps(d)) for d in species_details]
+        )
+        self.connection.commit()
+
+        return len(species_details)
+
+    def _normalize_tsn(self, tsn):
+        # TSN filters compare numbers, so leading zeros and surrounding whitespace don't matter
+        if isinstance(tsn, str) and tsn.strip().isdigit():
+            return str(int(tsn))
+        return tsn
+
+    def clear(self):
+        self.connection.execute("DELETE FROM tess_species")
+        self.connection.commit()
+
+    def start_staging(self):
+        '''
+        Sets up an empty staging table to load a full export into while the index keeps answering searches.
+        '''
+        self.connection.executescript('''
+            DROP TABLE IF EXISTS tess_species_staging;
+            CREATE TABLE tess_species_staging (
+                tsn TEXT,
+                sciname TEXT,
+                species_detail TEXT
+            );
+        ''')
+        self.connection.commit()
+
+    def swap_in_staging(self):
+        '''
+        Replaces the contents of the index with the staging table in a single transaction.
+        '''
+        with self.connection:
+            self.connection.execute("DELETE FROM tess_species")
+            self.connection.execute("INSERT INTO tess_species SELECT * FROM tess_species_staging ORDER BY rowid")
+            self.connection.execute("DROP TABLE tess_species_staging")
+
+    def discard_staging(self):
+        self.connection.execute("DROP TABLE IF EXISTS tess_species_staging")
+        self.connection.commit()
+
+    def search(self, criteria):
+        '''
+        :param criteria: TSN or scientific name
+        :return: list of matching SPECIES_DETAIL records
+        '''
+        if criteria.isdigit():
+            rows = self.connection.execute(
+                "SELECT species_detail FROM tess_species WHERE tsn = ? ORDER BY rowid", (self._normalize_tsn(criteria),)
+            )
+        else:
+            rows = self.connection.execute(
+                "SELECT species_detail FROM tess_species WHERE sciname = ? ORDER BY rowid", (criteria,)
+            )
+
+        return [json.loads(r[0]) for r in rows]
+
 
 class Ecos:
-    def __init__(self):
+    def __init__(self, session=None):
         self.property_registry = [
             {
                 'Properties': ['Status', 'Date Listed', 'Lead Region', 'Where Listed'],
@@ -76,7 +286,9 @@ class Ecos:
             "link": "document_link",
             "date": "publication_date"
         }
+        self.registry_by_table_name = {t["Table Name"]: t["Properties"] for t in self.property_registry}
         self.description = 'Set of functions for working with other parts of ECOS'
+        self.http = transport.get_transport(session)
 
     def extract_js_function_value(self, string):
         return string[string.find('"') + len('"'):string.rfind('"')]
@@ -91,19 +303,79 @@ class Ecos:
         except:
             return None
 
-    def scrape_ecos(self, ecos_url):
+    def scrape_ecos(self, ecos_url, fast=False):
+        '''
+        Scrapes an ECOS species profile page for the species names, ITIS TSN and the registered tables.
+
+        :param ecos_url: URL of the species profile
+        :param fast: use the fast extraction path (see parse_ecos_fast)
+        :return: Dictionary containing processing metadata and the extracted data
+        '''
+        return self._scrape_ecos_with(self.http, ecos_url, fast)
+
+    def scrape_ecos_many(self, ecos_urls, max_workers=8, max_per_host=2, delay=0.5, fast=True):
+        '''
+        Scrapes many ECOS species profile pages concurrently while limiting the load put on each host.
+
+        :param ecos_urls: list of species profile URLs
+        :param max_workers: number of worker threads
+        :param max_per_host: maximum number of concurrent requests to any one host
+        :param delay: minimum number of seconds between requests to the same host
+        :param fast: use the fast extraction path (see parse_ecos_fast)
+        :return: list of results in the same order as ecos_urls, each structured the same as scrape_ecos results; pages
+        that could not be retrieved or scraped get an error status with the error as the status_message
+        '''
+        throttle = transport.HostThrottle(self.http, max_per_host=max_per_host, delay=delay)
+
+        def scrape(ecos_url):
+            try:
+                return self._scrape_ecos_with(throttle, ecos_url, fast)
+            except Exception as e:
+                extracted_data = bis_utils.processing_metadata()
+                extracted_data["processing_metadata"]["api"] = ecos_url
+                extracted_data["processing_metadata"]["status_message"] = str(e)
+                return extracted_data
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(scrape, ecos_urls))
+
+    def parse_ecos_fast(self, content):
+        '''
+        Parses a species profile for the fast extraction path, using the lxml parser (when installed) and only
+        building the page title, the taxonomy section and the table caption and table elements.
+
+        :param content: page content
+        :return: BeautifulSoup document
+        '''
+        if ElementFilter is not None:
+            strainer = _EcosRegionFilter()
+        else:
+            strainer = SoupStrainer(_ecos_region)
+        try:
+            return BeautifulSoup(content, "lxml", parse_only=strainer)
+        except FeatureNotFound:
+            return BeautifulSoup(content, "html.parser", parse_only=strainer)
+
+    @transport.records_cache_status
+    def _scrape_ecos_with(self, http, ecos_url, fast):
         extracted_data = bis_utils.processing_metadata()
         extracted_data["processing_metadata"]["api"] = ecos_url
 
-        page = requests.get(ecos_url)
-        soup = BeautifulSoup(page.content, "html.parser")
+        page = http.get(ecos_url)
+        if fast:
+            soup = self.parse_ecos_fast(page.content)
+        else:
+            soup = BeautifulSoup(page.content, "html.parser")
 
         if not soup:
             return extracted_data
 
         extracted_data["processing_metadata"]["status"] = "success"
         extracted_data["data"] = dict()
-        extracted_data["data"]["ITIS TSN"] = self.itis_tsn(soup)
+        if fast:
+            extracted_data["data"]["ITIS TSN"] = self._itis_tsn_fast(soup, page.content)
+        else:
+            extracted_data["data"]["ITIS TSN"] = self.itis_tsn(soup)
 
         html_title = soup.find('title')
 
@@ -114,6 +386,9 @@ class Ecos:
             extracted_data["data"]["Scientific Name"] = html_title.text.replace('Species Profile for', '').strip()
             extracted_data["data"]["Common Name"] = None
 
+        parsed_parent_url = urlparse(ecos_url)
+        parent_url_root = f"{parsed_parent_url.scheme}://{parsed_parent_url.netloc}"
+
         for section in soup.findAll('div', {'class': 'table-caption'}):
             table_title = section.text.replace("(learn more)", "").strip()
             next_table = section.findNext('table')
@@ -127,7 +402,7 @@ class Ecos:
                     table_props.append(prop.text.strip())
                 this_table["Properties"] = table_props
 
-                if next((t for t in self.property_registry if t == this_table), None) is not None:
+                if self.registry_by_table_name.get(table_title) == table_props:
                     tbody = next_table.find('tbody')
                     if tbody is not None:
                         extracted_data["data"][this_table["Table Name"]] = list()
@@ -146,8 +421,7 @@ class Ecos:
                                     link_href = column.find('a')["href"]
                                     parsed_link = urlparse(link_href)
                                     if len(parsed_link.scheme) == 0:
-                                        parsed_parent_url = urlparse(ecos_url)
-                                        link_href = f"{parsed_parent_url.scheme}://{parsed_parent_url.netloc}{link_href}"
+                                        link_href = f"{parent_url_root}{link_href}"
                                     this_record["document_link"] = link_href
 
                             extracted_data["data"][this_table["Table Name"]].append(this_record)
@@ -159,3 +433,18 @@ class Ecos:
             )
 
         return extracted_data
+
+    def _itis_tsn_fast(self, soup, content):
+        # The TSN link is normally inside the taxonomy section, which the fast path keeps; if it isn't there, the
+        # whole page is parsed to look for it the same way itis_tsn does
+        taxonomy = soup.find('div', {'class': 'taxonomy new-row'})
+        if taxonomy is not None:
+            try:
+                link = taxonomy.findNext('div').findNext('a')
+            except AttributeError:
+                link = None
+            if link is not None and taxonomy in link.parents:
+                tsn = link['href'].split('=')[-1]
+                return tsn if tsn else None
+
+        return self.itis_tsn(BeautifulSoup(content, "html.parser"))
@@ -1,19 +1,44 @@
 import requests
+import copy
+import datetime
 import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 import geopandas as gpd
 from shapely.geometry import box
 from . import bis
+from . import transport
 
 bis_utils = bis.Utils()
 
 class Gap:
-    def __init__(self):
+    def __init__(self, session=None, bbox_table=None, species_index=None):
+        '''
+        :param session: optional Transport or requests.Session to send requests through instead of the shared default
+        transport
+        :param bbox_table: optional GapRangeBboxTable (or path to one) to read species range bounding boxes from
+        instead of querying the WFS for each species; boxes not found in the table are computed and added to it
+        :param species_index: optional GapSpeciesIndex (or path to one) of the GAP species collection to look up
+        species in instead of querying ScienceBase for each name
+        '''
         self.gap_species_collection = "527d0a83e4b0850ea0518326"
         self.sb_api_root = "https://www.sciencebase.gov/catalog/items"
         self.sb_geoserver = "https://www.sciencebase.gov/geoserver/CONUS_Range_2001v1/ows"
         self.bis_api_gap_state_metrics = "https://api.sciencebase.gov/bis-api/api/v1/gapmetrics/species/protection?feature_id=US_States_and_Territories%3Astate_fipscode%3A"
+        self.range_map_type_name = "CONUS_Range_2001v1:Species_CONUS_Range_2001v1"
+        self.http = transport.get_transport(session)
+        if isinstance(bbox_table, str):
+            bbox_table = GapRangeBboxTable(bbox_table)
+        self.bbox_table = bbox_table
+        if isinstance(species_index, str):
+            species_index = GapSpeciesIndex(species_index)
+        self.species_index = species_index
+        self.species_item_fields = "identifiers,files,webLinks,distributionLinks,dates"
 
-    def gap_species_search(self, scientificname, name_source=None, *args):
+    @transport.records_cache_status
+    def gap_species_search(self, scientificname, name_source=None, *args, skip=None, timeouts=None):
         '''
         This function looks for a GAP species in the core habitat maps collection in ScienceBase. If it finds a match,
         it assembles a combined GAP species document from available information in ScienceBase. This includes the basic
@@ -23,8 +48,12 @@ class Gap:
         the geospatial coverage to be expected for a species.
 
         :param scientificname: scientific name to search
+        :param skip: optional list of sub-resources to leave out of the GAP species document (see package_gap_species)
+        :param timeouts: optional timeout in seconds for each sub-resource request, or dictionary of timeouts by
+        sub-resource
         :return: Dictionary containing at least the processing metadata (date/time and URL used) and will contain a GAP
-        Species document with all the information assembled for the given species.
+        Species document with all the information assembled for the given species. Sub-resources that could not be
+        retrieved are listed with their errors in processing_metadata failed_resources.
         '''
 
         gap_result =  bis_utils.processing_metadata()
@@ -44,15 +73,94 @@ class Gap:
             f"&format=json&fields=identifiers,files,webLinks,distributionLinks,dates" \
             f"&filter=itemIdentifier%3D{identifier_param}"
 
-        sb_result = requests.get(gap_result["processing_metadata"]["api"]).json()
+        if self.species_index is not None:
+            species_items = self.species_index.lookup(scientificname)
+            sb_result = {"total": len(species_items), "items": species_items}
+        else:
+            sb_result = self.http.get(gap_result["processing_metadata"]["api"]).json()
 
         if sb_result["total"] == 1:
-            gap_result["data"] = self.package_gap_species(self.package_habmap_item(sb_result["items"][0]))
+            failed_resources = dict()
+            gap_result["data"] = self.package_gap_species(
+                self.package_habmap_item(sb_result["items"][0]),
+                skip=skip,
+                timeouts=timeouts,
+                failed_resources=failed_resources
+            )
             gap_result["processing_metadata"]["status"] = "success"
             gap_result["processing_metadata"]["status_message"] = "Exact Match"
+            if len(failed_resources) > 0:
+                gap_result["processing_metadata"]["failed_resources"] = failed_resources
 
         return gap_result
 
+    def harvest_gap_species(self, updated_since=None, page_size=100, max_workers=4):
+        '''
+        Retrieves all of the items in the GAP species collection with the fields used by gap_species_search. The first
+        page gives the total number of items, and the remaining pages are then fetched concurrently.
+
+        :param updated_since: optional datetime.date to only retrieve items last updated on or after
+        :param page_size: number of items to request per page
+        :param max_workers: number of pages to fetch concurrently
+        :return: list of ScienceBase items
+        '''
+        params = {
+            "parentId": self.gap_species_collection,
+            "format": "json",
+            "fields": self.species_item_fields,
+            "max": page_size,
+            # Concurrent offset pages only line up when every page is cut from the same, stable ordering
+            "sort": "id",
+            "order": "asc"
+        }
+        if updated_since is not None:
+            params["filter"] = "dateRange={}".format(json.dumps({
+                "dateType": "lastUpdated",
+                "choice": "range",
+                "start": updated_since.isoformat()
+            }))
+
+        def fetch_page(offset):
+            return self.http.get(self.sb_api_root, params=dict(params, offset=offset)).json()
+
+        first_page = fetch_page(0)
+        items = list(first_page.get("items", list()))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for page in executor.map(fetch_page, range(page_size, first_page["total"], page_size)):
+                items.extend(page.get("items", list()))
+
+        return items
+
+    def build_species_index(self, species_index=None, incremental=True, page_size=100, max_workers=4):
+        '''
+        Harvests the GAP species collection into a species index. With incremental set, only items last updated on or
+        after the most recent lastUpdated date already in the index are retrieved and replaced; otherwise the whole
+        collection is harvested. Items removed from the collection are only dropped by a full harvest.
+
+        :param species_index: GapSpeciesIndex or path to one; defaults to the index set on this Gap
+        :param incremental: only harvest items updated since the index was last built
+        :param page_size: number of items to request per page
+        :param max_workers: number of pages to fetch concurrently
+        :return: number of items harvested
+        '''
+        if species_index is None:
+            species_index = self.species_index
+        elif isinstance(species_index, str):
+            species_index = GapSpeciesIndex(species_index)
+        if species_index is None:
+            raise ValueError("A species index is needed to save the harvested items to")
+
+        updated_since = species_index.last_updated() if incremental else None
+        items = self.harvest_gap_species(
+            updated_since=datetime.date.fromisoformat(updated_since[:10]) if updated_since else None,
+            page_size=page_size,
+            max_workers=max_workers
+        )
+        species_index.update(items, replace_all=not incremental)
+
+        return len(items)
+
     def package_habmap_item(self, habmap_item):
         item = {
             "GAP Habitat Map Item": habmap_item["link"]["url"],
@@ -85,67 +193,218 @@ class Gap:
         return item
 
     def package_rangemap_item(self, sppcode, rangemap_url):
-        sb_range_map_item = requests.get(
-            f"{rangemap_url}?format=json&fields=distributionLinks"
-        ).json()
-
         rangemap_package = dict()
-        rangemap_package["GAP Range Map WMS"] = next((
-            l["uri"] for l in sb_range_map_item["distributionLinks"] if l["title"] == "External WMS Service"
-        ), None)
+        rangemap_package["GAP Range Map WMS"] = self.range_map_wms(rangemap_url)
 
-        rangemap_package["Range Bounding Box"] = self.gap_spp_range_bbox(sppcode)
+        rangemap_package["Range Bounding Box"] = self.range_bbox(sppcode)
 
         return rangemap_package
 
-    def package_gap_species(self, hab_map_package):
-        hab_map_package.update(
-            self.package_rangemap_item(
-                sppcode=hab_map_package["GAP_SpeciesCode"],
-                rangemap_url=hab_map_package["GAP Range Map Item"]
-            )
-        )
+    def package_gap_species(self, hab_map_package, skip=None, timeouts=None, failed_resources=None):
+        '''
+        Adds the sub-resources for a species to a packaged habitat map item, fetching them concurrently: the range
+        map WMS link from the range map item ("range_map"), the range bounding box ("bbox"), the modeling database
+        parameters ("parameters") and the cached ITIS information ("itis").
 
-        if hab_map_package["GAP Modeling Database Parameters URL"] is not None:
-            hab_map_package["GAP Modeling Database Parameters"] = json.loads(
-                requests.get(
-                    hab_map_package["GAP Modeling Database Parameters URL"]
-                ).text
-            )
+        :param hab_map_package: habitat map item packaged with package_habmap_item
+        :param skip: optional list of sub-resource names to leave out
+        :param timeouts: optional timeout in seconds for each sub-resource request, or dictionary of timeouts by
+        sub-resource name
+        :param failed_resources: optional dictionary to record the errors of sub-resources that could not be retrieved
+        in, leaving them out of the package; if not provided, the first error is raised
+        :return: GAP species document
+        '''
+        if skip is None:
+            skip = list()
+        if not isinstance(timeouts, dict):
+            timeouts = {name: timeouts for name in ["range_map", "bbox", "parameters", "itis"]}
 
-        if hab_map_package["GAP ITIS Information URL"] is not None:
-            hab_map_package["GAP ITIS Information"] = json.loads(
-                requests.get(
-                    hab_map_package["GAP ITIS Information URL"]
-                ).text
-            )
+        sub_resources = dict()
+        if "range_map" not in skip:
+            sub_resources["range_map"] = (self.range_map_wms, hab_map_package["GAP Range Map Item"])
+        if "bbox" not in skip:
+            sub_resources["bbox"] = (self.range_bbox, hab_map_package["GAP_SpeciesCode"])
+        if "parameters" not in skip and hab_map_package["GAP Modeling Database Parameters URL"] is not None:
+            sub_resources["parameters"] = (self._get_json, hab_map_package["GAP Modeling Database Parameters URL"])
+        if "itis" not in skip and hab_map_package["GAP ITIS Information URL"] is not None:
+            sub_resources["itis"] = (self._get_json, hab_map_package["GAP ITIS Information URL"])
+
+        with ThreadPoolExecutor(max_workers=max(1, len(sub_resources))) as executor:
+            futures = {
+                name: executor.submit(self.http.tracked(function), target, timeouts.get(name))
+                for name, (function, target) in sub_resources.items()
+            }
+
+        package_keys = {
+            "range_map": "GAP Range Map WMS",
+            "bbox": "Range Bounding Box",
+            "parameters": "GAP Modeling Database Parameters",
+            "itis": "GAP ITIS Information"
+        }
+        for name, future in futures.items():
+            try:
+                hab_map_package[package_keys[name]] = future.result()
+            except Exception as e:
+                if failed_resources is None:
+                    raise
+                failed_resources[name] = str(e)
 
         return hab_map_package
 
-    def gap_spp_range_bbox(self, sppcode):
+    def range_map_wms(self, rangemap_url, timeout=None):
+        '''
+        :param rangemap_url: URL of the GAP range map item in ScienceBase
+        :param timeout: optional request timeout in seconds
+        :return: URL of the range map WMS service, or None if the item has none
+        '''
+        sb_range_map_item = self._get_json(f"{rangemap_url}?format=json&fields=distributionLinks", timeout)
+
+        return next((
+            l["uri"] for l in sb_range_map_item["distributionLinks"] if l["title"] == "External WMS Service"
+        ), None)
+
+    def _get(self, url, timeout=None):
+        if timeout is None:
+            return self.http.get(url)
+        return self.http.get(url, timeout=timeout)
+
+    def _get_json(self, url, timeout=None):
+        return json.loads(self._get(url, timeout).text)
+
+    def gap_spp_range_bbox(self, sppcode, timeout=None):
         '''
         Queries the WFS for a given GAP species range and returns the total bounding box (all seasons) for the species.
 
         :param sppcode: GAP Species Code
+        :param timeout: optional request timeout in seconds
         :return: Simple bounding box in a list in EPSG:4326
         '''
         params = dict(
             service="WFS",
             version="1.0.0",
             request="GetFeature",
-            typeName="CONUS_Range_2001v1:Species_CONUS_Range_2001v1",
+            typeName=self.range_map_type_name,
             outputFormat="json",
             CQL_FILTER=f"SppCode='{sppcode}'"
         )
 
         q = requests.Request("GET", self.sb_geoserver, params=params).prepare().url
 
-        spp_range = gpd.read_file(q)
+        spp_range = gpd.read_file(BytesIO(self._get(q, timeout).content))
         spp_range = spp_range.to_crs({"init": "epsg:4326"})
 
         return spp_range.total_bounds.tolist()
 
-    def gap_metrics_species(self, us_states, GAP_SpeciesCode, range_bbox):
+    def range_bbox(self, sppcode, timeout=None):
+        '''
+        Returns the total bounding box for a GAP species range from the bbox table when one is set, falling back to
+        gap_spp_range_bbox (and saving the result to the table) for species not in it.
+
+        :param sppcode: GAP Species Code
+        :param timeout: optional WFS request timeout in seconds
+        :return: Simple bounding box in a list in EPSG:4326
+        '''
+        if self.bbox_table is None:
+            return self.gap_spp_range_bbox(sppcode, timeout)
+
+        range_bbox = self.bbox_table.get(sppcode)
+        if range_bbox is None:
+            range_bbox = self.gap_spp_range_bbox(sppcode, timeout)
+            self.bbox_table.put(sppcode, range_bbox)
+
+        return range_bbox
+
+    def build_range_bbox_table(self, bbox_table=None, sppcodes=None, page_size=50):
+        '''
+        Computes the total bounding box (all seasons) for many or all GAP species ranges in one paged pass through the
+        range map WFS and saves them to a bbox table. Features are requested already projected to EPSG:4326 and only
+        their bounds are kept, grouped by SppCode, so nothing but four numbers per species is held once a page is
+        read.
+
+        :param bbox_table: GapRangeBboxTable or path to one; defaults to the table set on this Gap
+        :param sppcodes: list of GAP Species Codes to compute; defaults to every species in the WFS
+        :param page_size: number of range features to request at a time
+        :return: dictionary of GAP Species Code to bounding box
+        '''
+        if bbox_table is None:
+            bbox_table = self.bbox_table
+        elif isinstance(bbox_table, str):
+            bbox_table = GapRangeBboxTable(bbox_table)
+        if bbox_table is None:
+            raise ValueError("A bbox table is needed to save the bounding boxes to")
+
+        if sppcodes is None:
+            cql_filters = [None]
+        else:
+            sppcodes = list(dict.fromkeys(sppcodes))
+            cql_filters = [
+                "SppCode IN ({})".format(",".join(f"'{c}'" for c in sppcodes[i:i + page_size]))
+                for i in range(0, len(sppcodes), page_size)
+            ]
+
+        range_bboxes = dict()
+        for cql_filter in cql_filters:
+            start_index = 0
+            while True:
+                params = dict(
+                    service="WFS",
+                    version="1.0.0",
+                    request="GetFeature",
+                    typeName=self.range_map_type_name,
+                    outputFormat="json",
+                    srsName="EPSG:4326",
+                    sortBy="SppCode",
+                    maxFeatures=page_size,
+                    startIndex=start_index
+                )
+                if cql_filter is not None:
+                    params["CQL_FILTER"] = cql_filter
+
+                q = requests.Request("GET", self.sb_geoserver, params=params).prepare().url
+                page = gpd.read_file(BytesIO(self.http.get(q).content))
+                if len(page) == 0:
+                    break
+
+                page_bounds = page.bounds
+                page_bounds["SppCode"] = page["SppCode"]
+                page_bounds = page_bounds.groupby("SppCode").agg(
+                    {"minx": "min", "miny": "min", "maxx": "max", "maxy": "max"}
+                )
+                for sppcode, b in page_bounds.iterrows():
+                    if sppcode in range_bboxes:
+                        # A species' seasonal range features can be split across pages
+                        existing = range_bboxes[sppcode]
+                        range_bboxes[sppcode] = [
+                            min(existing[0], b["minx"]),
+                            min(existing[1], b["miny"]),
+                            max(existing[2], b["maxx"]),
+                            max(existing[3], b["maxy"])
+                        ]
+                    else:
+                        range_bboxes[sppcode] = [b["minx"], b["miny"], b["maxx"], b["maxy"]]
+
+                if len(page) < page_size:
+                    break
+                start_index += page_size
+
+        bbox_table.update(range_bboxes)
+
+        return range_bboxes
+
+    def gap_metrics_species(self, us_states, GAP_SpeciesCode, range_bbox, state_metrics=None):
+        '''
+        Assembles the state protection metrics for a GAP species from the states its range bounding box intersects.
+
+        :param us_states: GeoDataFrame of US states with a STATEFP column (not used when state_metrics is provided)
+        :param GAP_SpeciesCode: GAP Species Code
+        :param range_bbox: range bounding box in EPSG:4326
+        :param state_metrics: optional GapStateMetrics to use its spatial index and cached state metrics, which is much
+        faster when running many species
+        :return: Dictionary with the GAP_SpeciesCode and a list of State Metrics
+        '''
+        if state_metrics is not None:
+            return state_metrics.metrics_species(GAP_SpeciesCode, range_bbox)
+
         species_metrics_report = {
             "GAP_SpeciesCode": GAP_SpeciesCode,
             "State Metrics": list()
@@ -157,10 +416,241 @@ class Gap:
         spp_bbox = spp_bbox.to_crs(us_states.crs)
         intersections = gpd.overlay(spp_bbox, us_states, how='intersection')
         for fips_code in intersections["STATEFP"]:
-            state_gap_metrics = requests.get(f"{self.bis_api_gap_state_metrics}{fips_code}").json()
+            state_gap_metrics = self.http.get(f"{self.bis_api_gap_state_metrics}{fips_code}").json()
             species_state_metrics = [i for i in state_gap_metrics["result"] if
                                      i["sppcode"] == GAP_SpeciesCode]
             if len(species_state_metrics) > 0:
                 species_metrics_report["State Metrics"].extend(species_state_metrics)
 
         return species_metrics_report
+
+
+class GapRangeBboxTable:
+    def __init__(self, table_path):
+        '''
+        SQLite table of GAP species range bounding boxes (EPSG:4326) keyed by GAP Species Code, built with
+        Gap.build_range_bbox_table.
+
+        :param table_path: path to the SQLite file
+        '''
+        self.table_path = table_path
+        self.connection = sqlite3.connect(table_path, check_same_thread=False)
+        # The connection is shared by the worker threads of package_gap_species
+        self._lock = threading.Lock()
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS range_bbox (
+                sppcode TEXT PRIMARY KEY,
+                minx REAL,
+                miny REAL,
+                maxx REAL,
+                maxy REAL
+            )
+        ''')
+        self.connection.commit()
+
+    def get(self, sppcode):
+        '''
+        :param sppcode: GAP Species Code
+        :return: bounding box in a list, or None if the species is not in the table
+        '''
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT minx, miny, maxx, maxy FROM range_bbox WHERE sppcode = ?", (sppcode,)
+            ).fetchone()
+
+        return list(row) if row is not None else None
+
+    def put(self, sppcode, range_bbox):
+        self.update({sppcode: range_bbox})
+
+    def update(self, range_bboxes):
+        '''
+        :param range_bboxes: dictionary of GAP Species Code to bounding box, replacing any existing boxes
+        '''
+        rows = [(sppcode, *[float(v) for v in b]) for sppcode, b in range_bboxes.items()]
+        with self._lock:
+            self.connection.executemany("INSERT OR REPLACE INTO range_bbox VALUES (?, ?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    def sppcodes(self):
+        with self._lock:
+            return [row[0] for row in self.connection.execute("SELECT sppcode FROM range_bbox ORDER BY sppcode")]
+
+
+class GapStateMetrics:
+    def __init__(self, us_states, gap=None, crs="epsg:4326"):
+        '''
+        Reusable helper for computing GAP state protection metrics for many species. The US states are projected once
+        to a fixed CRS with a prebuilt spatial index (STRtree) for finding the states a species range bounding box
+        intersects, and the protection metrics for each state are fetched once and cached, with a lookup from
+        species to metrics records across all of the cached states.
+
+        :param us_states: GeoDataFrame of US states with a STATEFP column
+        :param gap: Gap instance to use for the metrics API and its transport; defaults to a new Gap
+        :param crs: CRS to run intersections in; range bounding boxes are in EPSG:4326
+        '''
+        self.gap = gap if gap is not None else Gap()
+        self.crs = crs
+        self.us_states = us_states.to_crs(crs).reset_index(drop=True)
+        self.state_index = self.us_states.sindex
+        self.state_metrics = dict()
+        self.species_metrics = dict()
+        self._lock = threading.Lock()
+
+    def intersecting_states(self, range_bbox):
+        '''
+        :param range_bbox: range bounding box in EPSG:4326
+        :return: list of state FIPS codes whose areas intersect the bounding box
+        '''
+        b = box(range_bbox[0], range_bbox[1], range_bbox[2], range_bbox[3])
+        if self.crs != "epsg:4326":
+            b = gpd.GeoSeries([b], crs="epsg:4326").to_crs(self.crs).iloc[0]
+
+        fips_codes = list()
+        for i in sorted(self.state_index.query(b, predicate="intersects")):
+            # Like the overlay in Gap.gap_metrics_species, states that only touch the box are not counted
+            if self.us_states.geometry.iloc[i].intersection(b).area > 0:
+                fips_codes.append(self.us_states["STATEFP"].iloc[i])
+
+        return fips_codes
+
+    def fetch_state(self, fips_code):
+        '''
+        Fetches the protection metrics for a state unless they are already cached.
+
+        :param fips_code: state FIPS code
+        :return: list of species metrics records for the state
+        '''
+        if fips_code in self.state_metrics:
+            return self.state_metrics[fips_code]
+
+        state_gap_metrics = self.gap.http.get(f"{self.gap.bis_api_gap_state_metrics}{fips_code}").json()["result"]
+
+        with self._lock:
+            if fips_code not in self.state_metrics:
+                self.state_metrics[fips_code] = state_gap_metrics
+                for record in state_gap_metrics:
+                    self.species_metrics.setdefault(record["sppcode"], dict()).setdefault(fips_code, list()).append(
+                        record
+                    )
+
+        return self.state_metrics[fips_code]
+
+    def prefetch(self, fips_codes=None, max_workers=8):
+        '''
+        Fetches the protection metrics for many states concurrently.
+
+        :param fips_codes: list of state FIPS codes; defaults to every state in us_states
+        :param max_workers: number of worker threads
+        '''
+        if fips_codes is None:
+            fips_codes = self.us_states["STATEFP"].unique().tolist()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(self.fetch_state, fips_codes))
+
+    def species_state_metrics(self, sppcode, fips_codes):
+        '''
+        :param sppcode: GAP Species Code
+        :param fips_codes: list of state FIPS codes, fetched first if they are not cached
+        :return: list of the species' metrics records in the given states
+        '''
+        metrics = list()
+        for fips_code in fips_codes:
+            self.fetch_state(fips_code)
+            metrics.extend(copy.deepcopy(self.species_metrics.get(sppcode, dict()).get(fips_code, list())))
+
+        return metrics
+
+    def metrics_species(self, GAP_SpeciesCode, range_bbox):
+        '''
+        :param GAP_SpeciesCode: GAP Species Code
+        :param range_bbox: range bounding box in EPSG:4326
+        :return: Dictionary structured the same as Gap.gap_metrics_species
+        '''
+        return {
+            "GAP_SpeciesCode": GAP_SpeciesCode,
+            "State Metrics": self.species_state_metrics(GAP_SpeciesCode, self.intersecting_states(range_bbox))
+        }
+
+
+class GapSpeciesIndex:
+    def __init__(self, index_path):
+        '''
+        Index of the items in the GAP species collection, kept in a SQLite file and in memory, keyed by the key of
+        every identifier on each item (e.g. GAP_SpeciesCode, ITIS TSN and the scientific and common names) so that
+        gap_species_search can find species without querying ScienceBase. Built and refreshed with
+        Gap.build_species_index.
+
+        :param index_path: path to the SQLite index file
+        '''
+        self.index_path = index_path
+        self.connection = sqlite3.connect(index_path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS gap_items (
+                id TEXT PRIMARY KEY,
+                last_updated TEXT,
+                item TEXT
+            );
+            CREATE TABLE IF NOT EXISTS gap_identifiers (
+                type TEXT,
+                key TEXT,
+                id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS gap_identifiers_key ON gap_identifiers (key);
+            CREATE INDEX IF NOT EXISTS gap_identifiers_id ON gap_identifiers (id);
+        ''')
+        self.connection.commit()
+        self._load()
+
+    def _load(self):
+        self.items = {
+            item_id: json.loads(item) for item_id, item in self.connection.execute("SELECT id, item FROM gap_items")
+        }
+        self.identifiers = dict()
+        for identifier_type, key, item_id in self.connection.execute("SELECT type, key, id FROM gap_identifiers"):
+            self.identifiers.setdefault(key, dict()).setdefault(item_id, set()).add(identifier_type)
+
+    def update(self, items, replace_all=False):
+        '''
+        Adds items to the index, replacing any already in it with the same id.
+
+        :param items: list of ScienceBase items from the GAP species collection
+        :param replace_all: clear the index first
+        '''
+        cursor = self.connection.cursor()
+        if replace_all:
+            cursor.execute("DELETE FROM gap_items")
+            cursor.execute("DELETE FROM gap_identifiers")
+
+        item_rows = list()
+        identifier_rows = list()
+        for item in items:
+            last_updated = next((d["dateString"] for d in item.get("dates", list()) if d["type"] == "lastUpdated"), None)
+            item_rows.append((item["id"], last_updated, json.dumps(item)))
+            identifier_rows.extend((i["type"], str(i["key"]), item["id"]) for i in item.get("identifiers", list()))
+
+        cursor.executemany("DELETE FROM gap_identifiers WHERE id = ?", [(r[0],) for r in item_rows])
+        cursor.executemany("INSERT OR REPLACE INTO gap_items VALUES (?, ?, ?)", item_rows)
+        cursor.executemany("INSERT INTO gap_identifiers VALUES (?, ?, ?)", identifier_rows)
+        self.connection.commit()
+        self._load()
+
+    def lookup(self, key, identifier_type=None):
+        '''
+        Finds items with an identifier key, in the same way as an itemIdentifier filter on the collection.
+
+        :param key: identifier key (e.g. a scientific name or GAP Species Code)
+        :param identifier_type: optional identifier type to limit the match to
+        :return: list of matching ScienceBase items
+        '''
+        return [
+            copy.deepcopy(self.items[item_id]) for item_id, types in self.identifiers.get(str(key), dict()).items()
+            if identifier_type is None or identifier_type in types
+        ]
+
+    def last_updated(self):
+        '''
+        :return: the most recent lastUpdated date string of the items in the index, or None if it is empty
+        '''
+        return self.connection.execute("SELECT MAX(last_updated) FROM gap_items").fetchone()[0]
@@ -1,14 +1,23 @@
-import requests
 from . import bis
+from . import transport
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+import io
+import re
+import zipfile
+import xmltodict
 
 bis_utils = bis.Utils()
 
 
 class Gbif:
-    def __init__(self):
+    def __init__(self, session=None):
         self.gbif_spp_occ_summary_api = "https://api.gbif.org/v1/occurrence/search?country=US&limit=0&facet=institutionCode&facet=year&facet=basisOfRecord&{}={}"
+        self.gbif_occ_search_stub = "https://api.gbif.org/v1/occurrence/search?country=US&limit={}{}&{}={}"
+        self.gbif_occ_summary_facets = ["institutionCode", "year", "basisOfRecord"]
         self.gbif_species_suggest_stub = "https://api.gbif.org/v1/species/suggest?q={}"
         self.gbif_species_api_root = "http://api.gbif.org/v1/species/"
+        self.http = transport.get_transport(session)
 
     def build_gbif_taxonomy(self, gbif_species):
         taxonomy = list()
@@ -23,7 +32,87 @@ class Gbif:
 
         return taxonomy
 
-    def summarize_us_species(self, scientificname, name_source=None):
+    def get_occ_summary_url(self, search_param, search_value, facets=None, limit=0):
+        '''
+        Builds a US occurrence search URL that returns facet counts for a taxon.
+
+        :param search_param: occurrence search parameter to query on (e.g. taxonKey or scientificName)
+        :param search_value: value for the search parameter
+        :param facets: list of occurrence search facets; defaults to institutionCode, year and basisOfRecord
+        :param limit: number of occurrence records to return along with the facets
+        :return: occurrence search URL
+        '''
+        if facets is None:
+            facets = self.gbif_occ_summary_facets
+
+        return self.gbif_occ_search_stub.format(
+            limit,
+            "".join([f"&facet={facet}" for facet in facets]),
+            search_param,
+            search_value
+        )
+
+    @transport.records_cache_status
+    def summarize_us_species(self, scientificname, name_source=None, facets=None, limit=0):
+        return transport.run_steps(
+            self.http,
+            self.summarize_us_species_steps(scientificname, name_source, facets, limit)
+        )
+
+    async def summarize_us_species_async(self, scientificname, name_source=None, client=None, facets=None, limit=0):
+        '''
+        Asyncio version of summarize_us_species.
+
+        :param client: optional httpx.AsyncClient to send requests through
+        :return: result structured the same as summarize_us_species
+        '''
+        return await transport.run_steps_async(
+            self.http,
+            self.summarize_us_species_steps(scientificname, name_source, facets, limit),
+            client
+        )
+
+    def summarize_us_species_many(self, scientificnames, name_source=None, facets=None, limit=0, max_workers=8):
+        '''
+        Summarizes a list of species in a bounded pool of worker threads, yielding each result as soon as it is
+        complete rather than in the order of scientificnames (each result carries its Scientific Name in parameters).
+        Unlike summarize_us_species, the occurrence facet query is made on the taxonKey of the matched GBIF species
+        rather than the submitted name, so that all of the names (e.g. synonyms or spelling variants) that resolve to
+        the same taxon share a single facet query. Identical requests across the batch are only sent once and the
+        response is shared.
+
+        :param scientificnames: list of scientific names
+        :param name_source: name source to record in the parameters of each result
+        :param facets: list of occurrence search facets; defaults to institutionCode, year and basisOfRecord
+        :param limit: number of occurrence records to return along with the facets
+        :param max_workers: number of worker threads
+        :return: generator of results structured the same as summarize_us_species
+        '''
+        coalescer = transport.RequestCoalescer(self.http)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    self._summarize_us_species_with, coalescer, scientificname, name_source, facets, limit, True
+                )
+                for scientificname in scientificnames
+            ]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                # Don't leave queued work running if the caller stops reading results early
+                for future in futures:
+                    future.cancel()
+
+    @transport.records_cache_status
+    def _summarize_us_species_with(self, http, scientificname, name_source, facets, limit, by_taxon_key=False):
+        return transport.run_steps(
+            http,
+            self.summarize_us_species_steps(scientificname, name_source, facets, limit, by_taxon_key)
+        )
+
+    def summarize_us_species_steps(self, scientificname, name_source=None, facets=None, limit=0, by_taxon_key=False):
         result = bis_utils.processing_metadata()
         result["processing_metadata"]["status"] = "failure"
         result["processing_metadata"]["status_message"] = "Not Matched"
@@ -38,7 +127,7 @@ class Gbif:
         if name_source is not None:
             result["parameters"]["Name Source"] = name_source
 
-        gbif_spp_search_results = requests.get(self.gbif_species_suggest_stub.format(scientificname)).json()
+        gbif_spp_search_results = (yield self.gbif_species_suggest_stub.format(scientificname)).json()
 
         if len(gbif_spp_search_results) == 0:
             result["processing_metadata"]["status"] = "failure"
@@ -55,27 +144,25 @@ class Gbif:
             "synonym": gbif_spp_search_results[0]["synonym"]
         }
 
-        if "nubKey" in result["data"].keys():
+        if by_taxon_key:
             result["processing_metadata"]["api"].append(
-                self.gbif_spp_occ_summary_api.format(
-                    "taxon-Key",
-                    result["data"]["nubKey"]
-                )
+                self.get_occ_summary_url("taxonKey", result["data"]["key"], facets, limit)
+            )
+        elif "nubKey" in result["data"].keys():
+            result["processing_metadata"]["api"].append(
+                self.get_occ_summary_url("taxon-Key", result["data"]["nubKey"], facets, limit)
             )
         else:
             result["processing_metadata"]["api"].append(
-                self.gbif_spp_occ_summary_api.format(
-                    "scientificName",
-                    scientificname
-                )
+                self.get_occ_summary_url("scientificName", scientificname, facets, limit)
             )
 
-        gbif_occ_results = requests.get(
-            result["processing_metadata"]["api"][-1]
-        ).json()
+        gbif_occ_results = (yield result["processing_metadata"]["api"][-1]).json()
 
-        for key in ["endOfRecords", "limit", "offset", "results"]:
+        for key in ["endOfRecords", "limit", "offset"]:
             del gbif_occ_results[key]
+        if limit == 0:
+            del gbif_occ_results["results"]
 
         result["processing_metadata"]["status_message"] = "Matched"
         result["processing_metadata"]["status"] = "success"
@@ -83,3 +170,196 @@ class Gbif:
 
         return result
 
+
+class DwcArchive:
+    def __init__(self, archive_path, row_type="http://rs.tdwg.org/dwc/terms/Occurrence"):
+        '''
+        Reads the occurrence core of a Darwin Core Archive zip file, such as a GBIF occurrence download, straight from
+        the zip without extracting it. The layout of the data file comes from the archive's meta.xml. Archives without
+        a meta.xml (e.g. GBIF simple CSV downloads) are read from the header line of the first .txt or .csv file,
+        assumed to be tab delimited.
+
+        :param archive_path: path to the archive zip file
+        :param row_type: rowType of the core or extension to read from meta.xml
+        '''
+        self.archive_path = archive_path
+        self.row_type = row_type
+
+        with zipfile.ZipFile(archive_path) as archive:
+            if "meta.xml" in archive.namelist():
+                self._read_meta(archive.read("meta.xml"))
+            else:
+                self._read_header(archive)
+
+    def _read_meta(self, meta_xml):
+        meta = xmltodict.parse(meta_xml, dict_constructor=dict)["archive"]
+
+        files = list()
+        for file_type in ["core", "extension"]:
+            found = meta.get(file_type, list())
+            files.extend(found if isinstance(found, list) else [found])
+
+        try:
+            file_meta = next(f for f in files if f.get("@rowType") == self.row_type)
+        except StopIteration:
+            raise ValueError(f"No {self.row_type} file described in meta.xml")
+
+        def unescape(value):
+            return value.encode("latin-1", "backslashreplace").decode("unicode_escape")
+
+        locations = file_meta["files"]["location"]
+        self.data_file = locations[0] if isinstance(locations, list) else locations
+        self.delimiter = unescape(file_meta.get("@fieldsTerminatedBy", "\\t"))
+        self.quotechar = unescape(file_meta.get("@fieldsEnclosedBy", ""))
+        self.encoding = file_meta.get("@encoding", "UTF-8")
+        self.header_lines = int(file_meta.get("@ignoreHeaderLines", 0))
+
+        # Column names are the last part of each term URI (e.g. basisOfRecord), and the id column can also be read
+        # as "id"
+        self.columns = dict()
+        self.defaults = dict()
+        id_meta = file_meta.get("id", file_meta.get("coreid"))
+        if id_meta is not None:
+            self.columns["id"] = int(id_meta["@index"])
+
+        fields = file_meta.get("field", list())
+        for field in (fields if isinstance(fields, list) else [fields]):
+            name = re.split(r"[/#]", field["@term"])[-1]
+            if "@index" in field:
+                self.columns[name] = int(field["@index"])
+            else:
+                self.defaults[name] = field.get("@default")
+
+    def _read_header(self, archive):
+        try:
+            self.data_file = next(n for n in archive.namelist() if n.lower().endswith((".txt", ".csv")))
+        except StopIteration:
+            raise ValueError("No meta.xml or data file found in the archive")
+
+        self.delimiter = "\t"
+        self.quotechar = ""
+        self.encoding = "UTF-8"
+        self.header_lines = 1
+        self.defaults = dict()
+
+        with archive.open(self.data_file) as data:
+            header = io.TextIOWrapper(data, encoding=self.encoding, newline="").readline()
+        self.columns = {name: index for index, name in enumerate(header.rstrip("\r\n").split(self.delimiter))}
+
+    def iter_rows(self, columns=None):
+        '''
+        Streams the rows of the data file as dictionaries holding only the requested columns.
+
+        :param columns: list of column names to project; defaults to all of the columns in the file
+        :return: generator of dictionaries of column name to value, with empty values as None
+        '''
+        if columns is None:
+            columns = list(self.columns.keys()) + list(self.defaults.keys())
+
+        unknown = [c for c in columns if c not in self.columns and c not in self.defaults]
+        if len(unknown) > 0:
+            raise KeyError(f"Columns not found in the archive: {', '.join(unknown)}")
+
+        projection = [(c, self.columns[c]) for c in columns if c in self.columns]
+        defaults = {c: self.defaults[c] for c in columns if c in self.defaults}
+
+        if self.quotechar:
+            reader_options = {"delimiter": self.delimiter, "quotechar": self.quotechar}
+        else:
+            reader_options = {"delimiter": self.delimiter, "quoting": csv.QUOTE_NONE}
+
+        with zipfile.ZipFile(self.archive_path) as archive, archive.open(self.data_file) as data:
+            text = io.TextIOWrapper(data, encoding=self.encoding, newline="")
+            reader = csv.reader(text, **reader_options)
+            for i in range(self.header_lines):
+                next(reader, None)
+
+            for values in reader:
+                if len(values) == 0:
+                    continue
+                row = dict(defaults)
+                for name, index in projection:
+                    value = values[index] if index < len(values) else None
+                    row[name] = value if value else None
+                yield row
+
+    def iter_chunks(self, columns=None, chunk_size=100000):
+        '''
+        Streams the rows of the data file in lists of up to chunk_size rows.
+
+        :param columns: list of column names to project; defaults to all of the columns in the file
+        :param chunk_size: number of rows in each chunk
+        :return: generator of lists of row dictionaries
+        '''
+        chunk = list()
+        for row in self.iter_rows(columns):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = list()
+        if len(chunk) > 0:
+            yield chunk
+
+    def occurrence_summaries(
+            self,
+            group_by="taxonKey",
+            facets=("institutionCode", "year", "basisOfRecord"),
+            facet_limit=10,
+            country_code=None,
+            chunk_size=100000
+    ):
+        '''
+        Computes the same counts and facets that Gbif.summarize_us_species gets from the occurrence search API for every
+        taxon in the archive in one pass. Rows are read in chunks, and only the running value counts are kept in
+        memory.
+
+        :param group_by: column to summarize by (e.g. taxonKey, acceptedTaxonKey, speciesKey or scientificName)
+        :param facets: list of columns to count values for
+        :param facet_limit: number of the most frequent values to report for each facet, as with the API's facetLimit
+        :param country_code: only count occurrences with this countryCode (e.g. "US"); defaults to all rows
+        :param chunk_size: number of rows to read at a time
+        :return: dictionary of group_by value to an occurrence summary structured like the "Occurrence Summary" from
+        Gbif.summarize_us_species (count and facets)
+        '''
+        columns = [group_by] + [f for f in facets if f != group_by]
+        if country_code is not None and "countryCode" not in columns:
+            columns.append("countryCode")
+
+        group_counts = dict()
+        for chunk in self.iter_chunks(columns, chunk_size):
+            grouped = dict()
+            for row in chunk:
+                if country_code is not None and row["countryCode"] != country_code:
+                    continue
+                grouped.setdefault(row[group_by], list()).append(
+                    {f: row[f] for f in facets if row[f] is not None}
+                )
+            for group, facet_rows in grouped.items():
+                try:
+                    group_counts[group].update(facet_rows)
+                except KeyError:
+                    group_counts[group] = bis.AttributeValueCount(facet_rows)
+
+        return {
+            group: self._package_occurrence_summary(counts, facets, facet_limit)
+            for group, counts in group_counts.items()
+        }
+
+    def _package_occurrence_summary(self, counts, facets, facet_limit):
+        summary = {
+            "count": counts.length,
+            "facets": list()
+        }
+        for facet in facets:
+            try:
+                value_counts = counts[facet]
+            except KeyError:
+                continue
+            del value_counts[None]
+            summary["facets"].append({
+                # Facet field names follow the API's enumeration style, e.g. basisOfRecord is BASIS_OF_RECORD
+                "field": re.sub(r"(?<!^)(?=[A-Z])", "_", facet).upper(),
+                "counts": [{"name": name, "count": count} for name, count in value_counts.most_common(facet_limit)]
+            })
+
+        return summary
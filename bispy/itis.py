@@ -1,12 +1,73 @@
-import requests
 from . import bis
+from . import transport
 import re
+import copy
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 bis_utils = bis.Utils()
 
+
+def _field_layout(fields, **options):
+    layout = {"fields": fields, "max_position": max(position for name, position in fields)}
+    layout.update(options)
+    return layout
+
+
+# Positions of the properties we use within each of the "$" delimited attributes in ITIS Solr documents
+itis_field_layouts = {
+    "geographicDivision": _field_layout([
+        ("geographic_value", 1), ("update_date", 2)
+    ]),
+    "jurisdiction": _field_layout([
+        ("jurisdiction_value", 1), ("origin", 2), ("update_date", 3)
+    ]),
+    "expert": _field_layout([
+        ("reference_type", 1), ("expert_id", 2), ("expert_name", 3), ("expert_comment", 4), ("create_date", 5),
+        ("update_date", 6)
+    ]),
+    "publication": _field_layout([
+        ("reference_type", 1), ("reference_id", 2), ("author", 3), ("title", 5)
+    ], other_from=6),
+    "otherSource": _field_layout([
+        ("reference_type", 1), ("source_id", 2), ("source_type", 3), ("source_name", 4), ("version", 5),
+        ("acquisition_date", 6), ("source_comment", 7), ("create_date", 8), ("update_date", 9)
+    ], raw_text=True),
+    "comment": _field_layout([
+        ("comment_id", 1), ("commentator", 2), ("comment_text", 3), ("create_date", 4), ("update_date", 5)
+    ], raw_text=True)
+}
+
+vernacular_field_layout = _field_layout([
+    ("name", 1), ("language", 2)
+])
+
+
+def _package_itis_doc(itis_doc):
+    return Itis().package_itis_json(itis_doc)
+
+
 class Itis:
-    def __init__(self):
+    def __init__(self, local_index=None, session=None, tsn_cache=None):
+        '''
+        :param local_index: optional ItisLocalIndex (or path to one built with ItisLocalIndex.build) to run searches
+        against instead of the ITIS Solr service
+        :param session: optional Transport or requests.Session to send requests through instead of the shared default
+        transport
+        :param tsn_cache: optional TsnCache of packaged documents to use instead of the default for the backend, which
+        is the shared default_tsn_cache for the ITIS Solr service or the local index's own tsn_cache
+        '''
         self.description = "Set of functions for interacting with ITIS Solr API and repackaging results for usability"
+        if isinstance(local_index, str):
+            local_index = ItisLocalIndex(local_index)
+        self.local_index = local_index
+        self.http = transport.get_transport(session)
+        if tsn_cache is None:
+            tsn_cache = local_index.tsn_cache if local_index is not None else default_tsn_cache
+        self.tsn_cache = tsn_cache
 
     def package_itis_json(self, itisDoc):
         itis_data = {}
@@ -22,110 +83,22 @@ class Itis:
             itisDoc["date_created"] = itisDoc.pop("createDate")
             itisDoc["date_modified"] = itisDoc.pop("updateDate")
 
-            # Parse geographicDivision and jurisdiction into a more useful format
-            list_geographicDivision = itisDoc.pop("geographicDivision", None)
-            list_jurisdiction = itisDoc.pop("jurisdiction", None)
-
-            if list_geographicDivision is not None:
-                itisDoc["geographicDivision"] = list()
-                for geodiv in list_geographicDivision:
-                    itisDoc["geographicDivision"].append({
-                        "geographic_value": geodiv.split("$")[1],
-                        "update_date": geodiv.split("$")[2]
-                    })
-
-            if list_jurisdiction is not None:
-                itisDoc["jurisdiction"] = list()
-                for jur in list_jurisdiction:
-                    itisDoc["jurisdiction"].append({
-                        "jurisdiction_value": jur.split("$")[1],
-                        "origin": jur.split("$")[2],
-                        "update_date": jur.split("$")[3]
-                    })
-
-            # Parse expert(s) into a more useful format
-            list_expert = itisDoc.pop("expert", None)
-
-            if list_expert is not None:
-                itisDoc["expert"] = list()
-                for exp in list_expert:
-                    itisDoc["expert"].append({
-                        "reference_type": exp.split("$")[1],
-                        "expert_id": exp.split("$")[2],
-                        "expert_name": exp.split("$")[3],
-                        "expert_comment": exp.split("$")[4],
-                        "create_date": exp.split("$")[5],
-                        "update_date": exp.split("$")[6]
-                    })
-
-            # Parse publications(s) into a more useful format
-            list_publication = itisDoc.pop("publication", None)
-
-            if list_publication is not None:
-                itisDoc["publication"] = list()
-                for pub in list_publication:
-                    pub_doc = {
-                        "reference_type": pub.split("$")[1],
-                        "reference_id": pub.split("$")[2],
-                        "author": pub.split("$")[3],
-                        "title": pub.split("$")[5],
-                    }
-                    for index, var in enumerate(pub.split("$")[6:]):
-                        if len(var) > 0:
-                            pub_doc[f"other_variable_{index}"] = var
-                    itisDoc["publication"].append(pub_doc)
-
-            # Parse otherSource into a more useful format
-            list_other_source = itisDoc.pop("otherSource", None)
-
-            if list_other_source is not None:
-                itisDoc["otherSource"] = list()
-                for src in list_other_source:
-                    try:
-                        itisDoc["otherSource"].append({
-                            "reference_type": src.split("$")[1],
-                            "source_id": src.split("$")[2],
-                            "source_type": src.split("$")[3],
-                            "source_name": src.split("$")[4],
-                            "version": src.split("$")[5],
-                            "acquisition_date": src.split("$")[6],
-                            "source_comment": src.split("$")[7],
-                            "create_date": src.split("$")[8],
-                            "update_date": src.split("$")[9]
-                        })
-                    except:
-                        itisDoc["otherSource"].append({
-                            "raw_text": src
-                        })
-
-            # Parse comment into a more useful format
-            list_comment = itisDoc.pop("comment", None)
-
-            if list_comment is not None:
-                itisDoc["comment"] = list()
-                for comment in list_comment:
-                    try:
-                        itisDoc["comment"].append({
-                            "comment_id": comment.split("$")[1],
-                            "commentator": comment.split("$")[2],
-                            "comment_text": comment.split("$")[3],
-                            "create_date": comment.split("$")[4],
-                            "update_date": comment.split("$")[5]
-                        })
-                    except:
-                        itisDoc["comment"].append({
-                            "raw_text": comment
-                        })
+            # Parse the "$" delimited attributes (geographicDivision, jurisdiction, expert, publication, otherSource,
+            # comment) into a more useful format
+            for attribute, layout in itis_field_layouts.items():
+                list_values = itisDoc.pop(attribute, None)
+                if list_values is not None:
+                    itisDoc[attribute] = [self.parse_itis_field(value, layout) for value in list_values]
 
-            # Make a clean structure of the taxonomic hierarchy
             # Make a clean structure of the taxonomic hierarchy
             itisDoc["biological_taxonomy"] = []
             for rank in itisDoc['hierarchySoFarWRanks'][0][itisDoc['hierarchySoFarWRanks'][0].find(':$') + 2:-1].split(
                     "$"):
-                thisRankName = {}
-                thisRankName["rank"] = rank.split(":")[0]
-                thisRankName["name"] = rank.split(":")[1]
-                itisDoc["biological_taxonomy"].append(thisRankName)
+                rank_parts = rank.split(":")
+                itisDoc["biological_taxonomy"].append({
+                    "rank": rank_parts[0],
+                    "name": rank_parts[1]
+                })
             itisDoc.pop("hierarchySoFarWRanks", None)
 
             # Make a clean, usable list of the hierarchy so far for display or listing
@@ -134,12 +107,9 @@ class Itis:
 
             # Make a clean structure of common names
             if "vernacular" in itisDoc:
-                itisDoc["commonnames"] = []
-                for commonName in itisDoc['vernacular']:
-                    thisCommonName = {}
-                    thisCommonName["name"] = commonName.split('$')[1]
-                    thisCommonName["language"] = commonName.split('$')[2]
-                    itisDoc["commonnames"].append(thisCommonName)
+                itisDoc["commonnames"] = [
+                    self.parse_itis_field(commonName, vernacular_field_layout) for commonName in itisDoc['vernacular']
+                ]
                 itisDoc.pop("vernacular", None)
 
             # Add the new ITIS doc to the ITIS data structure and return
@@ -147,10 +117,52 @@ class Itis:
 
         return itis_data
 
-    def get_itis_search_url(self, searchstr, fuzzy=False, validAccepted=True):
-        fuzzyLevel = "~0.8"
+    def parse_itis_field(self, value, layout):
+        '''
+        Splits a "$" delimited ITIS attribute value once and picks out its parts using a field layout.
 
-        api_stub = "https://services.itis.gov/?wt=json&rows=10&q="
+        :param value: raw "$" delimited string from an ITIS Solr document
+        :param layout: dictionary with "fields" (list of property name and position pairs), and optionally
+        "other_from" (position from which any further non-empty parts are kept as other_variable_n) and "raw_text"
+        (return the raw value if it does not have all of the expected parts instead of raising an error)
+        :return: dictionary of parsed properties
+        '''
+        parts = value.split("$") if isinstance(value, str) else None
+
+        if layout.get("raw_text") and (parts is None or len(parts) <= layout["max_position"]):
+            return {"raw_text": value}
+
+        parsed = {name: parts[position] for name, position in layout["fields"]}
+
+        if "other_from" in layout:
+            for index, var in enumerate(parts[layout["other_from"]:]):
+                if len(var) > 0:
+                    parsed[f"other_variable_{index}"] = var
+
+        return parsed
+
+    def package_itis_docs(self, itis_docs, max_workers=None):
+        '''
+        Runs package_itis_json over a list of ITIS Solr documents, such as from a bulk ITIS dump. If max_workers is set,
+        documents are packaged in that many worker processes.
+
+        :param itis_docs: list of ITIS Solr documents
+        :param max_workers: number of worker processes to use; documents are packaged in this process if None
+        :return: list of packaged ITIS documents in the same order as the input
+        '''
+        if max_workers is None:
+            return [self.package_itis_json(doc) for doc in itis_docs]
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(_package_itis_doc, itis_docs, chunksize=256))
+
+    def get_itis_search_term(self, searchstr):
+        '''
+        Determines the ITIS Solr field and escaped value used to search for a scientific name or TSN.
+
+        :param searchstr: scientific name or TSN
+        :return: tuple of the Solr field name and the escaped search value
+        '''
         search_term = "nameWOInd"
         searchstr = str(searchstr)
 
@@ -161,6 +173,14 @@ class Itis:
             if searchstr.find("var.") > 0 or searchstr.find("ssp.") > 0 or searchstr.find(" x ") > 0:
                 search_term = "nameWInd"
 
+        return search_term, searchstr
+
+    def get_itis_search_url(self, searchstr, fuzzy=False, validAccepted=True):
+        fuzzyLevel = "~0.8"
+
+        api_stub = "https://services.itis.gov/?wt=json&rows=10&q="
+        search_term, searchstr = self.get_itis_search_term(searchstr)
+
         api = f"{api_stub}{search_term}:{searchstr}"
 
         if fuzzy:
@@ -171,7 +191,241 @@ class Itis:
 
         return api
 
+    def get_itis_batch_search_url(self, names_or_tsns, rows, start=0):
+        '''
+        Builds a single ITIS Solr query that matches any of a list of scientific names or TSNs exactly.
+
+        :param names_or_tsns: list of scientific names or TSNs
+        :param rows: number of documents to return
+        :param start: offset of the first document to return for paging through results
+        :return: ITIS Solr query URL
+        '''
+        terms = ["%s:%s" % self.get_itis_search_term(n) for n in names_or_tsns]
+        return f"https://services.itis.gov/?wt=json&rows={rows}&start={start}&q={'%20OR%20'.join(terms)}"
+
+    @transport.records_cache_status
     def search(self, name_or_tsn, name_source=None):
+        return transport.run_steps(self.http, self.search_steps(name_or_tsn, name_source))
+
+    async def search_async(self, name_or_tsn, name_source=None, client=None):
+        '''
+        Asyncio version of search, including any follow-up query for an accepted TSN.
+
+        :param name_or_tsn: scientific name or TSN
+        :param name_source: name source to record in the parameters
+        :param client: optional httpx.AsyncClient to send requests through
+        :return: search result structured the same as search
+        '''
+        return await transport.run_steps_async(self.http, self.search_steps(name_or_tsn, name_source), client)
+
+    def search_steps(self, name_or_tsn, name_source=None):
+        # TSN lookups can be answered from documents we have already packaged
+        cached_doc = self.tsn_cache.get(name_or_tsn) if name_or_tsn.isdigit() else None
+
+        # Set up the primary search method for an exact match on scientific name
+        # We have to try the main search queries because the ITIS service does not return an elegant error
+        try:
+            if cached_doc is not None:
+                exact_docs = [cached_doc]
+            else:
+                exact_docs = yield from self.search_docs_steps(name_or_tsn)
+        except:
+            return self.package_search_result(name_or_tsn, name_source, None)
+
+        fuzzy_docs = None
+        if len(exact_docs) == 0:
+            # if we didn't get anything with an exact name match, run the sequence using fuzziness level
+            try:
+                fuzzy_docs = yield from self.search_docs_steps(name_or_tsn, fuzzy=True)
+            except:
+                return self.package_search_result(name_or_tsn, name_source, exact_docs, None)
+
+        accepted_doc = None
+        accepted_tsn = self.accepted_tsn_to_follow(exact_docs, fuzzy_docs)
+        if accepted_tsn is not None:
+            accepted_doc = self.tsn_cache.get(accepted_tsn)
+            if accepted_doc is None:
+                accepted_docs = yield from self.search_docs_steps(accepted_tsn)
+                accepted_doc = accepted_docs[0]
+
+        return self.package_search_result(name_or_tsn, name_source, exact_docs, fuzzy_docs, accepted_doc)
+
+    def search_docs(self, name_or_tsn, fuzzy=False):
+        '''
+        Runs a single exact or fuzzy ITIS query for a scientific name or TSN against the ITIS Solr service or the
+        local index if one is in use.
+
+        :param name_or_tsn: scientific name or TSN
+        :param fuzzy: run the query with the fuzziness level used in get_itis_search_url
+        :return: list of ITIS Solr docs
+        '''
+        return transport.run_steps(self.http, self.search_docs_steps(name_or_tsn, fuzzy))
+
+    def search_docs_steps(self, name_or_tsn, fuzzy=False):
+        if self.local_index is not None:
+            return self.local_index.search(name_or_tsn, fuzzy=fuzzy)
+
+        response = yield self.get_itis_search_url(name_or_tsn, fuzzy, False)
+        return response.json()["response"]["docs"]
+
+    @transport.records_cache_status
+    def search_many(self, names_or_tsns, name_source=None, chunk_size=50):
+        '''
+        Runs the same matching logic as search for a list of scientific names or TSNs, but packs many exact match
+        terms into each ITIS Solr query. Fuzzy queries are only run for the names with no exact match, and all of the
+        accepted TSNs that need to be followed are fetched together in batched queries.
+
+        The processing_metadata details in each result carry the same single-name query URLs that search would have
+        used. If a batched query fails (e.g. a name with characters Solr cannot parse), the names in that chunk are
+        run through search individually.
+
+        :param names_or_tsns: list of scientific names or TSNs
+        :param name_source: name source to record in the parameters of each result
+        :param chunk_size: number of names or TSNs to put into each batched query
+        :return: list of results in the same order as names_or_tsns, each structured the same as search results
+        '''
+        if self.local_index is not None:
+            return [self.search(str(n), name_source) for n in names_or_tsns]
+
+        unique_names = list(dict.fromkeys(str(n) for n in names_or_tsns))
+        results = dict()
+
+        # Exact matches for all names, in chunks
+        exact_docs = dict()
+        for i in range(0, len(unique_names), chunk_size):
+            chunk = unique_names[i:i + chunk_size]
+            try:
+                exact_docs.update(self._batch_exact_match(chunk))
+            except Exception:
+                for name in chunk:
+                    results[name] = self.search(name, name_source)
+
+        # Fuzzy matches for the names we didn't find
+        fuzzy_docs = dict()
+        for name, docs in exact_docs.items():
+            if len(docs) == 0:
+                try:
+                    fuzzy_docs[name] = self.search_docs(name, fuzzy=True)
+                except:
+                    fuzzy_docs[name] = None
+
+        # Accepted TSNs to follow for invalid/not accepted matches, fetched together
+        accepted_tsns = {
+            name: self.accepted_tsn_to_follow(docs, fuzzy_docs.get(name)) for name, docs in exact_docs.items()
+        }
+        accepted_docs = dict()
+        unique_tsns = list()
+        for tsn in dict.fromkeys(tsn for tsn in accepted_tsns.values() if tsn is not None):
+            cached_doc = self.tsn_cache.get(tsn)
+            if cached_doc is not None:
+                accepted_docs[tsn] = cached_doc
+            else:
+                unique_tsns.append(tsn)
+        for i in range(0, len(unique_tsns), chunk_size):
+            try:
+                batch_docs = self._batch_exact_match(unique_tsns[i:i + chunk_size])
+            except Exception:
+                continue
+            accepted_docs.update({tsn: docs[0] for tsn, docs in batch_docs.items() if len(docs) > 0})
+
+        for name, docs in exact_docs.items():
+            accepted_doc = None
+            if accepted_tsns[name] is not None:
+                if accepted_tsns[name] not in accepted_docs:
+                    # The accepted TSN could not be retrieved, so we report the follow-up query as failed
+                    results[name] = self._hard_fail(
+                        self.package_search_result(
+                            name, name_source, copy.deepcopy(docs), copy.deepcopy(fuzzy_docs.get(name))
+                        ),
+                        self.get_itis_search_url(accepted_tsns[name], False, False)
+                    )
+                    continue
+                accepted_doc = copy.deepcopy(accepted_docs[accepted_tsns[name]])
+
+            results[name] = self.package_search_result(
+                name,
+                name_source,
+                copy.deepcopy(docs),
+                copy.deepcopy(fuzzy_docs.get(name)),
+                accepted_doc
+            )
+
+        return [copy.deepcopy(results[str(n)]) for n in names_or_tsns]
+
+    def _batch_exact_match(self, names_or_tsns, rows_per_name=10):
+        # Solr docs matching each name or TSN exactly, limited to the number of rows a single-name search returns
+        matched_docs = {n: list() for n in names_or_tsns}
+        # Solr matches names exactly (case sensitive), but names that differ only in whitespace are sent as the same
+        # query value, so each key maps to all of the names that share it
+        lookup = dict()
+        for n in names_or_tsns:
+            search_term, searchstr = self.get_itis_search_term(n)
+            lookup.setdefault((search_term, ' '.join(n.split())), list()).append(n)
+
+        rows = len(names_or_tsns) * rows_per_name
+        start = 0
+        num_found = 1
+        while start < num_found:
+            response = self.http.get(self.get_itis_batch_search_url(names_or_tsns, rows, start)).json()["response"]
+            num_found = response["numFound"]
+            if len(response["docs"]) == 0:
+                break
+            for doc in response["docs"]:
+                doc_names = list()
+                for search_term in ["nameWOInd", "nameWInd", "tsn"]:
+                    if search_term in doc:
+                        for n in lookup.get((search_term, ' '.join(str(doc[search_term]).split())), list()):
+                            if n not in doc_names:
+                                doc_names.append(n)
+                for n in doc_names:
+                    if len(matched_docs[n]) < rows_per_name:
+                        matched_docs[n].append(doc)
+            start += len(response["docs"])
+
+        return matched_docs
+
+    def accepted_tsn_to_follow(self, exact_docs, fuzzy_docs=None):
+        '''
+        Determines whether the ITIS record that would be the point of discovery for a search is not accepted for use,
+        in which case we need to follow the accepted TSN in that document.
+
+        :param exact_docs: list of ITIS Solr docs from the exact match query
+        :param fuzzy_docs: list of ITIS Solr docs from the fuzzy match query, if one was run
+        :return: accepted TSN to follow or None
+        '''
+        if exact_docs is None:
+            return None
+
+        if len(exact_docs) == 1:
+            discovered_doc = exact_docs[0]
+        elif len(exact_docs) == 0 and fuzzy_docs:
+            discovered_doc = fuzzy_docs[0]
+        else:
+            return None
+
+        if discovered_doc["usage"] in ["invalid", "not accepted"]:
+            return discovered_doc["acceptedTSN"][0]
+
+        return None
+
+    def _hard_fail(self, itis_result, url):
+        itis_result["processing_metadata"]["details"].append({"Hard Fail Query": url})
+        itis_result["processing_metadata"]["status_message"] = "Hard Fail Query"
+        itis_result["processing_metadata"]["status"] = "error"
+        itis_result.pop("data", None)
+        return itis_result
+
+    def package_search_result(self, name_or_tsn, name_source, exact_docs, fuzzy_docs=None, accepted_doc=None):
+        '''
+        Packages the ITIS Solr docs retrieved for a name or TSN into a search result with processing metadata.
+
+        :param name_or_tsn: scientific name or TSN searched
+        :param name_source: name source to record in the parameters
+        :param exact_docs: list of docs from the exact match query; None if the query failed
+        :param fuzzy_docs: list of docs from the fuzzy match query; None if it was not run or failed
+        :param accepted_doc: doc for the accepted TSN followed from an invalid/not accepted match
+        :return: search result
+        '''
         itis_result = bis_utils.processing_metadata()
         itis_result["processing_metadata"]["status"] = "failure"
         itis_result["processing_metadata"]["status_message"] = "Not Matched"
@@ -189,95 +443,303 @@ class Itis:
         if name_source is not None:
             itis_result["parameters"]["Name Source"] = name_source
 
-        # Set up the primary search method for an exact match on scientific name
         url_exactMatch = self.get_itis_search_url(name_or_tsn, False, False)
 
-        # We have to try the main search queries because the ITIS service does not return an elegant error
-        try:
-            r_exactMatch = requests.get(url_exactMatch).json()
-        except:
-            itis_result["processing_metadata"]["details"].append({"Hard Fail Query": url_exactMatch})
-            itis_result["processing_metadata"]["status_message"] = "Hard Fail Query"
-            itis_result["processing_metadata"]["status"] = "error"
-            return itis_result
+        if exact_docs is None:
+            return self._hard_fail(itis_result, url_exactMatch)
 
-        if r_exactMatch["response"]["numFound"] == 0:
+        if len(exact_docs) == 0:
 
             itis_result["processing_metadata"]["details"].append({"Exact Match Fail": url_exactMatch})
 
-            # if we didn't get anything with an exact name match, run the sequence using fuzziness level
             url_fuzzyMatch = self.get_itis_search_url(name_or_tsn, True, False)
 
-            try:
-                r_fuzzyMatch = requests.get(url_fuzzyMatch).json()
-            except:
-                itis_result["processing_metadata"]["details"].append({"Hard Fail Query": url_fuzzyMatch})
-                itis_result["processing_metadata"]["status_message"] = "Hard Fail Query"
-                itis_result["processing_metadata"]["status"] = "error"
-                return itis_result
+            if fuzzy_docs is None:
+                return self._hard_fail(itis_result, url_fuzzyMatch)
 
-            if r_fuzzyMatch["response"]["numFound"] == 0:
+            if len(fuzzy_docs) == 0:
                 # If we still get no results then provide the specific detailed result
                 itis_result["processing_metadata"]["details"].append({"Fuzzy Match Fail": url_fuzzyMatch})
                 return itis_result
 
-            elif r_fuzzyMatch["response"]["numFound"] > 0:
-                # If we got one or more results with a fuzzy match, we will just use the first result
-                itis_result["data"] = []
+            # If we got one or more results with a fuzzy match, we will just use the first result
+            self._package_discovered_doc(itis_result, fuzzy_docs[0], "Fuzzy Match", url_fuzzyMatch, accepted_doc)
 
-                # We need to check to see if the discovered ITIS record is accepted for use. If not, we need to follow
-                # the accepted TSN in that document
-                if r_fuzzyMatch["response"]["docs"][0]["usage"] in ["invalid", "not accepted"]:
-                    url_tsnSearch = self.get_itis_search_url(
-                        r_fuzzyMatch["response"]["docs"][0]["acceptedTSN"][0], False, False
-                    )
-                    r_tsnSearch = requests.get(url_tsnSearch).json()
-                    itis_result["data"].append(self.package_itis_json(r_tsnSearch["response"]["docs"][0]))
-                    itis_result["processing_metadata"]["status"] = "success"
-                    itis_result["processing_metadata"]["status_message"] = "Followed Accepted TSN"
-                    itis_result["processing_metadata"]["details"].append({"TSN Search": url_tsnSearch})
-                else:
-                    itis_result["processing_metadata"]["status"] = "success"
-                    itis_result["processing_metadata"]["status_message"] = "Fuzzy Match"
-
-                # Whether or not we needed to follow an accepted TSN, we will also include the ITIS record that was
-                # the point of discovery
-                itis_result["processing_metadata"]["details"].append({"Fuzzy Match": url_fuzzyMatch})
-                itis_result["data"].append(self.package_itis_json(r_fuzzyMatch["response"]["docs"][0]))
-
-        elif r_exactMatch["response"]["numFound"] == 1:
+        elif len(exact_docs) == 1:
             # If we found only one record with the exact match query, we treat that as a useful point of discovery
+            self._package_discovered_doc(itis_result, exact_docs[0], "Exact Match", url_exactMatch, accepted_doc)
 
-            itis_result["data"] = list()
-
-            # We need to check to see if the discovered ITIS record is accepted for use. If not, we need to follow
-            # the accepted TSN in that document
-            if r_exactMatch["response"]["docs"][0]["usage"] in ["invalid", "not accepted"]:
-                url_tsnSearch = self.get_itis_search_url(
-                    r_exactMatch["response"]["docs"][0]["acceptedTSN"][0], False, False
-                )
-                r_tsnSearch = requests.get(url_tsnSearch).json()
-                itis_result["data"].append(self.package_itis_json(r_tsnSearch["response"]["docs"][0]))
-                itis_result["processing_metadata"]["status"] = "success"
-                itis_result["processing_metadata"]["status_message"] = "Followed Accepted TSN"
-                itis_result["processing_metadata"]["details"].append({"TSN Search": url_tsnSearch})
-            else:
-                itis_result["processing_metadata"]["status"] = "success"
-                itis_result["processing_metadata"]["status_message"] = "Exact Match"
-
-            # Whether or not we needed to follow an accepted TSN, we will also include the ITIS record that was the
-            # point of discovery
-            itis_result["processing_metadata"]["details"].append({"Exact Match": url_exactMatch})
-            itis_result["data"].append(self.package_itis_json(r_exactMatch["response"]["docs"][0]))
-
-        elif r_exactMatch["response"]["numFound"] > 1:
+        else:
             itis_result["processing_metadata"]["details"].append({"Multi Match": url_exactMatch})
             itis_result["processing_metadata"]["details"].append({
-                "Number Valid Results": len([i for i in r_exactMatch["response"]["docs"]
-                                             if i["usage"] in ["valid", "accepted"]])
+                "Number Valid Results": len([i for i in exact_docs if i["usage"] in ["valid", "accepted"]])
             })
-            itis_result["data"] = [self.package_itis_json(i) for i in r_exactMatch["response"]["docs"]]
+            itis_result["data"] = [self.package_tsn_doc(i) for i in exact_docs]
             itis_result["processing_metadata"]["status"] = "success"
             itis_result["processing_metadata"]["status_message"] = "Found multiple matches"
 
         return itis_result
+
+    def package_tsn_doc(self, itis_doc):
+        '''
+        Packages an ITIS Solr doc with package_itis_json and keeps the packaged document in the TSN cache. Documents
+        that come from the TSN cache are marked as already packaged and are returned as they are.
+
+        :param itis_doc: ITIS Solr doc or packaged document from the TSN cache
+        :return: packaged ITIS document
+        '''
+        if isinstance(itis_doc, PackagedItisDoc):
+            return dict(itis_doc)
+
+        packaged_doc = self.package_itis_json(itis_doc)
+        self.tsn_cache.put(packaged_doc["tsn"], packaged_doc)
+
+        return packaged_doc
+
+    def _package_discovered_doc(self, itis_result, discovered_doc, match_type, url_match, accepted_doc):
+        itis_result["data"] = list()
+
+        # If the discovered ITIS record is not accepted for use, we include the record for the accepted TSN that was
+        # followed from it
+        if accepted_doc is not None:
+            url_tsnSearch = self.get_itis_search_url(discovered_doc["acceptedTSN"][0], False, False)
+            itis_result["data"].append(self.package_tsn_doc(accepted_doc))
+            itis_result["processing_metadata"]["status"] = "success"
+            itis_result["processing_metadata"]["status_message"] = "Followed Accepted TSN"
+            itis_result["processing_metadata"]["details"].append({"TSN Search": url_tsnSearch})
+        else:
+            itis_result["processing_metadata"]["status"] = "success"
+            itis_result["processing_metadata"]["status_message"] = match_type
+
+        # Whether or not we needed to follow an accepted TSN, we will also include the ITIS record that was the point
+        # of discovery
+        itis_result["processing_metadata"]["details"].append({match_type: url_match})
+        itis_result["data"].append(self.package_tsn_doc(discovered_doc))
+
+
+class PackagedItisDoc(dict):
+    '''
+    Packaged ITIS document as kept in a TsnCache, marked so that it is not run through package_itis_json again.
+    '''
+
+
+class TsnCache:
+    def __init__(self, maxsize=10000):
+        '''
+        Bounded, least recently used cache of packaged ITIS documents keyed by TSN, so that accepted TSNs followed from
+        many synonyms and repeated TSN lookups are only queried and packaged once. Documents are copied on the way in
+        and out so that changes made to search results do not alter the cache.
+
+        :param maxsize: maximum number of packaged documents to keep
+        '''
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._docs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tsn):
+        with self._lock:
+            try:
+                packaged_doc = self._docs[str(tsn)]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._docs.move_to_end(str(tsn))
+            self.hits += 1
+
+        return copy.deepcopy(packaged_doc)
+
+    def put(self, tsn, packaged_doc):
+        packaged_doc = PackagedItisDoc(copy.deepcopy(packaged_doc))
+        with self._lock:
+            self._docs[str(tsn)] = packaged_doc
+            self._docs.move_to_end(str(tsn))
+            while len(self._docs) > self.maxsize:
+                self._docs.popitem(last=False)
+
+    def stats(self):
+        '''
+        :return: dictionary of hit and miss counts, hit rate, and the current and maximum number of documents
+        '''
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else None,
+            "size": len(self._docs),
+            "maxsize": self.maxsize
+        }
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+default_tsn_cache = TsnCache()
+
+
+class ItisLocalIndex:
+    def __init__(self, index_path):
+        '''
+        SQLite index of ITIS Solr documents for resolving names and TSNs without calling the ITIS service. Exact
+        matches are looked up by tsn, nameWOInd or nameWInd (case sensitive, as in the ITIS Solr service). Fuzzy matches approximate the "~0.8"
+        fuzziness level used in get_itis_search_url: up to min(2, 20% of the search term length) edits, with
+        candidates found through a trigram table and then checked by edit distance.
+
+        :param index_path: path to the SQLite index file
+        '''
+        self.index_path = index_path
+        self.fuzzy_similarity = 0.8
+        self.max_edits = 2
+        self.rows = 10
+        self.connection = sqlite3.connect(index_path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS itis_docs (
+                tsn TEXT PRIMARY KEY,
+                nameWOInd TEXT,
+                nameWInd TEXT,
+                doc TEXT
+            );
+            CREATE INDEX IF NOT EXISTS itis_docs_nameWOInd ON itis_docs (nameWOInd);
+            CREATE INDEX IF NOT EXISTS itis_docs_nameWInd ON itis_docs (nameWInd);
+            CREATE TABLE IF NOT EXISTS itis_trigrams (
+                field TEXT,
+                gram TEXT,
+                tsn TEXT
+            );
+            CREATE INDEX IF NOT EXISTS itis_trigrams_gram ON itis_trigrams (field, gram);
+            CREATE INDEX IF NOT EXISTS itis_trigrams_tsn ON itis_trigrams (tsn);
+        ''')
+        self.connection.commit()
+        # Packaged documents from this index are kept apart from those from the ITIS Solr service
+        self.tsn_cache = TsnCache()
+
+    def build(self, source, batch_size=10000):
+        '''
+        Builds (or adds to) the index from ITIS Solr documents.
+
+        :param source: iterable of ITIS Solr docs or the path to a file containing them, either a saved Solr JSON
+        response, a JSON array of docs, or JSON Lines (one doc per line)
+        :param batch_size: number of docs to write to the index at a time
+        :return: number of docs indexed
+        '''
+        if isinstance(source, str):
+            source = self._read_docs(source)
+
+        cursor = self.connection.cursor()
+
+        count = 0
+        docs = list()
+        trigrams = list()
+        for doc in source:
+            tsn = str(doc["tsn"])
+            docs.append((tsn, doc.get("nameWOInd"), doc.get("nameWInd"), json.dumps(doc)))
+            for field in ["nameWOInd", "nameWInd"]:
+                if doc.get(field):
+                    trigrams.extend((field, gram, tsn) for gram in self._trigrams(doc[field]))
+            count += 1
+
+            if len(docs) >= batch_size:
+                self._write_batch(cursor, docs, trigrams)
+                docs, trigrams = list(), list()
+
+        self._write_batch(cursor, docs, trigrams)
+        self.connection.commit()
+
+        return count
+
+    def _write_batch(self, cursor, docs, trigrams):
+        cursor.executemany("DELETE FROM itis_trigrams WHERE tsn = ?", [(d[0],) for d in docs])
+        cursor.executemany("INSERT OR REPLACE INTO itis_docs VALUES (?, ?, ?, ?)", docs)
+        cursor.executemany("INSERT INTO itis_trigrams VALUES (?, ?, ?)", trigrams)
+
+    def _read_docs(self, path):
+        with open(path, "r") as f:
+            first_char = f.read(1)
+            while first_char.isspace():
+                first_char = f.read(1)
+
+        if first_char == "{":
+            with open(path, "r") as f:
+                try:
+                    data = json.loads(f.read())
+                except ValueError:
+                    data = None
+            if isinstance(data, dict) and "response" in data:
+                return data["response"]["docs"]
+
+        return bis_utils.iter_doc_cache(path)
+
+    def _trigrams(self, value):
+        padded = f"  {' '.join(value.split()).lower()} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def _edit_distance(self, a, b, max_distance):
+        # Optimal string alignment distance (Levenshtein plus transpositions, as in Lucene fuzzy queries); returns
+        # max_distance + 1 as soon as the distance is known to exceed max_distance
+        if abs(len(a) - len(b)) > max_distance:
+            return max_distance + 1
+
+        previous_previous = None
+        previous = list(range(len(b) + 1))
+        for i in range(1, len(a) + 1):
+            current = [i] + [0] * len(b)
+            for j in range(1, len(b) + 1):
+                cost = 0 if a[i - 1] == b[j - 1] else 1
+                current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+                if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                    current[j] = min(current[j], previous_previous[j - 2] + 1)
+            if min(current) > max_distance:
+                return max_distance + 1
+            previous_previous, previous = previous, current
+
+        return previous[-1]
+
+    def search(self, name_or_tsn, fuzzy=False):
+        '''
+        Looks up ITIS Solr docs in the same way as the exact and fuzzy queries built by get_itis_search_url.
+
+        :param name_or_tsn: scientific name or TSN
+        :param fuzzy: run a fuzzy match instead of an exact match
+        :return: list of at most 10 ITIS Solr docs
+        '''
+        search_term, searchstr = Itis().get_itis_search_term(name_or_tsn)
+        value = ' '.join(searchstr.split('\\%20'))
+
+        if not fuzzy:
+            # The collation is given explicitly for indexes built when the name columns were case insensitive
+            rows = self.connection.execute(
+                f"SELECT doc FROM itis_docs WHERE {search_term} = ? COLLATE BINARY ORDER BY rowid LIMIT ?",
+                (value, self.rows)
+            ).fetchall()
+            return [json.loads(r[0]) for r in rows]
+
+        if search_term == "tsn":
+            return list()
+
+        value = value.lower()
+        max_edits = min(self.max_edits, int((1 - self.fuzzy_similarity) * len(value)))
+        grams = self._trigrams(value)
+
+        # Each edit can remove at most four of the trigrams in the search value
+        min_shared = max(1, len(grams) - 4 * max_edits)
+        candidates = self.connection.execute(
+            f"SELECT tsn FROM itis_trigrams WHERE field = ? AND gram IN ({','.join('?' * len(grams))}) "
+            f"GROUP BY tsn HAVING COUNT(*) >= ?",
+            [search_term, *grams, min_shared]
+        ).fetchall()
+
+        matches = list()
+        for (tsn,) in candidates:
+            name, doc = self.connection.execute(
+                f"SELECT {search_term}, doc FROM itis_docs WHERE tsn = ?", (tsn,)
+            ).fetchone()
+            distance = self._edit_distance(value, ' '.join(name.split()).lower(), max_edits)
+            if distance <= max_edits:
+                matches.append((distance, name, doc))
+
+        matches.sort(key=lambda m: (m[0], m[1]))
+        return [json.loads(m[2]) for m in matches[:self.rows]]
@@ -1,12 +1,22 @@
-import requests
 import os
 import re
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from . import bis
+from . import transport
 
 bis_utils = bis.Utils()
 
 class Iucn:
-    def __init__(self):
+    def __init__(self, session=None, species_table=None):
+        '''
+        :param session: optional Transport or requests.Session to send requests through instead of the shared default
+        transport
+        :param species_table: optional IucnSpeciesTable (or path to one built with build_species_table) to answer
+        search_species from instead of calling the Red List API for each species
+        '''
         self.iucn_api_base = "http://apiv3.iucnredlist.org/api/v3"
         self.iucn_species_api = f"{self.iucn_api_base}/species"
         self.iucn_threats_api = f"{self.iucn_api_base}/threats/species/id"
@@ -16,6 +26,12 @@ class Iucn:
         self.iucn_resolvable_id_base = "https://www.iucnredlist.org/species/"
         self.doi_pattern_start = "http://dx.doi.org"
         self.doi_pattern_end = ".en"
+        self.doi_regex = re.compile(f"{self.doi_pattern_start}(.*?){self.doi_pattern_end}")
+        self.secondary_id_regex = re.compile(r"e\.T(\d+)A(.*?)\.")
+        self.http = transport.get_transport(session)
+        if isinstance(species_table, str):
+            species_table = IucnSpeciesTable(species_table)
+        self.species_table = species_table
 
         self.iucn_categories = {
             "NE": "Not Evaluated",
@@ -32,7 +48,20 @@ class Iucn:
             "LR/cd": "Not Categorized (in review)"
         }
 
+    @transport.records_cache_status
     def search_species(self, scientificname, name_source=None):
+        return transport.run_steps(self.http, self.search_species_steps(scientificname, name_source))
+
+    async def search_species_async(self, scientificname, name_source=None, client=None):
+        '''
+        Asyncio version of search_species, including the citation lookup.
+
+        :param client: optional httpx.AsyncClient to send requests through
+        :return: result structured the same as search_species
+        '''
+        return await transport.run_steps_async(self.http, self.search_species_steps(scientificname, name_source), client)
+
+    def search_species_steps(self, scientificname, name_source=None):
         iucn_result = bis_utils.processing_metadata()
         iucn_result["processing_metadata"]["api"] = f"{self.iucn_species_api}/{scientificname}"
         iucn_result["parameters"] = {
@@ -40,14 +69,24 @@ class Iucn:
             "Name Source": name_source
         }
 
+        if self.species_table is not None:
+            table_data = self.species_table.get(scientificname)
+            if table_data is not None:
+                iucn_result["processing_metadata"]["status"] = "success"
+                iucn_result["processing_metadata"]["status_message"] = "Species Name Matched"
+                iucn_result["data"] = table_data
+                return iucn_result
+            if self.species_table.has_listing() and not self.species_table.has_name(scientificname):
+                iucn_result["processing_metadata"]["status"] = "failure"
+                iucn_result["processing_metadata"]["status_message"] = "Species Name Not Found"
+                return iucn_result
+
         if "token_iucn" not in os.environ:
             iucn_result["processing_metadata"]["status"] = "error"
             iucn_result["processing_metadata"]["status_message"] = "API token not present to run IUCN Red List query"
             return iucn_result
 
-        iucn_response = requests.get(
-            f'{iucn_result["processing_metadata"]["api"]}?token={os.environ["token_iucn"]}'
-        )
+        iucn_response = yield f'{iucn_result["processing_metadata"]["api"]}?token={os.environ["token_iucn"]}'
 
         if iucn_response.status_code != 200:
             iucn_result["processing_metadata"]["status"] = "error"
@@ -79,32 +118,251 @@ class Iucn:
             "iucn_population_trend": iucn_species_data['result'][0]['population_trend'],
         }
 
-        iucn_citation_response = requests.get(
-            f"{self.iucn_citation_api}/{iucn_result['data']['iucn_taxonid']}?token={os.environ['token_iucn']}"
+        iucn_citation_response = (
+            yield f"{self.iucn_citation_api}/{iucn_result['data']['iucn_taxonid']}?token={os.environ['token_iucn']}"
         ).json()
 
-        iucn_result["data"]["citation_string"] = iucn_citation_response["result"][0]["citation"]
+        iucn_result["data"].update(
+            self.parse_citation(iucn_result["data"]["iucn_taxonid"], iucn_citation_response["result"][0]["citation"])
+        )
+
+        # Species details are filled into the table as they are looked up
+        if self.species_table is not None:
+            self.species_table.update_details([iucn_result["data"]])
+
+        return iucn_result
+
+    def parse_citation(self, taxonid, citation_string):
+        '''
+        Pulls the assessment (secondary) identifier and DOI out of a Red List citation using the precompiled patterns.
+
+        :param taxonid: IUCN taxon id the citation is for
+        :param citation_string: citation from the Red List citation API
+        :return: dictionary with citation_string, iucn_secondary_identifier, resolvable_identifier and doi
+        '''
+        citation = {
+            "citation_string": citation_string,
+            "iucn_secondary_identifier": None,
+            "resolvable_identifier": None,
+            "doi": None
+        }
+
+        # The first "e.T<taxonid>A<assessment id>." in the citation
+        position = 0
+        match_secondary_id = self.secondary_id_regex.search(citation_string, position)
+        while match_secondary_id is not None and match_secondary_id.group(1) != str(taxonid):
+            position = match_secondary_id.start() + 1
+            match_secondary_id = self.secondary_id_regex.search(citation_string, position)
 
-        regex_string_secondary_id = f"e\.T{iucn_result['data']['iucn_taxonid']}A(.*?)\."
-        match_secondary_id = re.search(regex_string_secondary_id,
-                                              iucn_result["data"]["citation_string"])
         if match_secondary_id is not None:
-            iucn_result["data"]["iucn_secondary_identifier"] = match_secondary_id.group(1)
-            iucn_result["data"]["resolvable_identifier"] = \
+            citation["iucn_secondary_identifier"] = match_secondary_id.group(2)
+            citation["resolvable_identifier"] = \
                 f"{self.iucn_resolvable_id_base}" \
-                f"{iucn_result['data']['iucn_taxonid']}/" \
-                f"{match_secondary_id.group(1)}"
-        else:
-            iucn_result["data"]["iucn_secondary_identifier"] = None
-            iucn_result["data"]["resolvable_identifier"] = None
-
-        regex_string_doi = f"{self.doi_pattern_start}(.*?){self.doi_pattern_end}"
-        match_iucn_doi = re.search(regex_string_doi, iucn_result["data"]["citation_string"])
+                f"{taxonid}/" \
+                f"{match_secondary_id.group(2)}"
 
+        match_iucn_doi = self.doi_regex.search(citation_string)
         if match_iucn_doi is not None:
-            iucn_result["data"]["doi"] = f"{self.doi_pattern_start}{match_iucn_doi.group(1)}{self.doi_pattern_end}"
+            citation["doi"] = f"{self.doi_pattern_start}{match_iucn_doi.group(1)}{self.doi_pattern_end}"
+
+        return citation
+
+    def build_species_table(self, species_table=None, scientificnames=None, max_workers=4, batch_size=100):
+        '''
+        Builds or refreshes a local table of the Red List data returned by search_species. The species listing is
+        paged through once to get every taxon id, scientific name and category. The Red List API has no bulk
+        citation or assessment service, so the assessment date, population trend and citation are only fetched for
+        the species in scientificnames (e.g. all SGCN species) that are new to the table, have changed category or
+        assessment date, or have details older than the table's max_age_days. Details for other species are fetched
+        lazily by search_species when they are first looked up.
+
+        :param species_table: IucnSpeciesTable or path to one; defaults to the table set on this Iucn
+        :param scientificnames: optional list of scientific names to fetch details for now
+        :param max_workers: number of species to fetch details for at the same time
+        :param batch_size: number of fetched species details to write to the table at a time
+        :return: dictionary with the number of species listed, the number of species with details fetched, and the
+        taxon ids that failed with their errors
+        '''
+        if species_table is None:
+            species_table = self.species_table
+        elif isinstance(species_table, str):
+            species_table = IucnSpeciesTable(species_table)
+        if species_table is None:
+            raise ValueError("A species table is needed to save the Red List data to")
+        if "token_iucn" not in os.environ:
+            raise ValueError("API token not present to run IUCN Red List query")
+
+        token = os.environ["token_iucn"]
+
+        listed = list()
+        page_number = 0
+        while True:
+            page = self.http.get(f"{self.iucn_species_api}/page/{page_number}?token={token}").json()
+            if len(page.get("result", list())) == 0:
+                break
+            listed.extend(
+                (s["taxonid"], s["scientific_name"], s["category"], s.get("assessment_date")) for s in page["result"]
+            )
+            page_number += 1
+
+        species_table.update_listing(listed)
+        to_fetch = species_table.needs_details(scientificnames) if scientificnames is not None else list()
+
+        def fetch_details(taxonid):
+            species = self.http.get(f"{self.iucn_species_api}/id/{taxonid}?token={token}").json()["result"][0]
+            citation = self.http.get(f"{self.iucn_citation_api}/{taxonid}?token={token}").json()["result"][0]
+            data = {
+                "iucn_taxonid": species['taxonid'],
+                "iucn_status_code": species['category'],
+                "iucn_status_name": self.iucn_categories[species['category']],
+                "record_date": species['assessment_date'],
+                "iucn_population_trend": species['population_trend'],
+            }
+            data.update(self.parse_citation(data["iucn_taxonid"], citation["citation"]))
+            return data
+
+        fetched = 0
+        failed_taxa = dict()
+        details = list()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(fetch_details, taxonid): taxonid for taxonid in to_fetch}
+            for future in as_completed(futures):
+                try:
+                    details.append(future.result())
+                except Exception as e:
+                    failed_taxa[futures[future]] = str(e)
+                    continue
+                if len(details) >= batch_size:
+                    species_table.update_details(details)
+                    fetched += len(details)
+                    details = list()
+        species_table.update_details(details)
+        fetched += len(details)
+
+        return {
+            "Species Listed": len(listed),
+            "Species Details Fetched": fetched,
+            "Failed Taxa": failed_taxa
+        }
+
+
+class IucnSpeciesTable:
+    def __init__(self, table_path, max_age_days=None):
+        '''
+        SQLite table of Red List species keyed by IUCN taxon id and scientific name, holding the data structure that
+        search_species returns for each species whose details have been fetched. Built with
+        Iucn.build_species_table.
+
+        :param table_path: path to the SQLite file
+        :param max_age_days: optional number of days after which fetched species details are treated as missing, so
+        that reassessments that keep the same category are picked up
+        '''
+        self.table_path = table_path
+        self.max_age_days = max_age_days
+        self.connection = sqlite3.connect(table_path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS iucn_species (
+                taxonid INTEGER PRIMARY KEY,
+                scientific_name TEXT COLLATE NOCASE,
+                category TEXT,
+                data TEXT,
+                fetched REAL
+            );
+            CREATE INDEX IF NOT EXISTS iucn_species_scientific_name ON iucn_species (scientific_name);
+        ''')
+        self.connection.commit()
+
+    def has_listing(self):
+        # True once the table holds the species listing, so that names missing from it are not on the Red List
+        return self.connection.execute("SELECT COUNT(*) FROM iucn_species").fetchone()[0] > 0
+
+    def update_listing(self, listed):
+        '''
+        Adds the species listing, clearing the details of species whose category or assessment date has changed.
+
+        :param listed: list of (taxonid, scientific_name, category, assessment_date) tuples; assessment_date can be
+        None when the listing does not include it
+        '''
+        cursor = self.connection.cursor()
+        for taxonid, scientific_name, category, assessment_date in listed:
+            existing = cursor.execute(
+                "SELECT category, data FROM iucn_species WHERE taxonid = ?", (taxonid,)
+            ).fetchone()
+            if existing is None:
+                cursor.execute(
+                    "INSERT INTO iucn_species VALUES (?, ?, ?, NULL, NULL)", (taxonid, scientific_name, category)
+                )
+                continue
+
+            reassessed = assessment_date is not None and existing[1] is not None and \
+                json.loads(existing[1])["record_date"] != assessment_date
+            if existing[0] != category or reassessed:
+                cursor.execute(
+                    "UPDATE iucn_species SET scientific_name = ?, category = ?, data = NULL, fetched = NULL "
+                    "WHERE taxonid = ?",
+                    (scientific_name, category, taxonid)
+                )
+        self.connection.commit()
+
+    def needs_details(self, scientificnames):
+        '''
+        :param scientificnames: list of scientific names
+        :return: list of taxon ids for those names with details that are missing or older than max_age_days
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS wanted_names (scientific_name TEXT COLLATE NOCASE)")
+        cursor.execute("DELETE FROM wanted_names")
+        cursor.executemany("INSERT INTO wanted_names VALUES (?)", [(n,) for n in set(scientificnames)])
+
+        return [
+            row[0] for row in cursor.execute(
+                "SELECT DISTINCT taxonid FROM iucn_species JOIN wanted_names USING (scientific_name) "
+                "WHERE data IS NULL OR fetched < ?",
+                (self._oldest_fresh(),)
+            )
+        ]
+
+    def _oldest_fresh(self):
+        # Fetch time before which details are stale
+        if self.max_age_days is None:
+            return 0
+        return time.time() - self.max_age_days * 86400
+
+    def update_details(self, details):
+        '''
+        :param details: list of search_species data dictionaries
+        '''
+        now = time.time()
+        self.connection.executemany(
+            "UPDATE iucn_species SET data = ?, fetched = ? WHERE taxonid = ?",
+            [(json.dumps(d), now, d["iucn_taxonid"]) for d in details]
+        )
+        self.connection.commit()
+
+    def has_name(self, scientific_name):
+        return self.connection.execute(
+            "SELECT 1 FROM iucn_species WHERE scientific_name = ?", (scientific_name,)
+        ).fetchone() is not None
+
+    def get(self, scientificname_or_taxonid):
+        '''
+        :param scientificname_or_taxonid: scientific name or IUCN taxon id
+        :return: search_species data dictionary, or None if the species is not in the table or its details are missing
+        or older than max_age_days
+        '''
+        if isinstance(scientificname_or_taxonid, int) or str(scientificname_or_taxonid).isdigit():
+            row = self.connection.execute(
+                "SELECT data FROM iucn_species WHERE taxonid = ? AND fetched >= ?",
+                (int(scientificname_or_taxonid), self._oldest_fresh())
+            ).fetchone()
         else:
-            iucn_result["data"]["doi"] = None
+            row = self.connection.execute(
+                "SELECT data FROM iucn_species WHERE scientific_name = ? AND data IS NOT NULL AND fetched >= ? "
+                "ORDER BY taxonid",
+                (scientificname_or_taxonid, self._oldest_fresh())
+            ).fetchone()
 
-        return iucn_result
+        if row is None or row[0] is None:
+            return None
 
+        return json.loads(row[0])
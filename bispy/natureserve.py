@@ -1,17 +1,31 @@
-import requests
 import xmltodict
 from . import bis
+from . import transport
 
 bis_utils = bis.Utils()
 
 
 class Natureserve:
-    def __init__(self):
+    def __init__(self, session=None):
         self.description = "Set of functions for working with the NatureServe APIs"
         self.ns_api_base = "https://services.natureserve.org/idd/rest/v1"
         self.us_name_search_api = "nationalSpecies/summary/nameSearch?nationCode=US"
+        self.http = transport.get_transport(session)
 
+    @transport.records_cache_status
     def search(self, scientificname, name_source=None):
+        return transport.run_steps(self.http, self.search_steps(scientificname, name_source))
+
+    async def search_async(self, scientificname, name_source=None, client=None):
+        '''
+        Asyncio version of search.
+
+        :param client: optional httpx.AsyncClient to send requests through
+        :return: result structured the same as search
+        '''
+        return await transport.run_steps_async(self.http, self.search_steps(scientificname, name_source), client)
+
+    def search_steps(self, scientificname, name_source=None):
 
         result = bis_utils.processing_metadata()
         result["processing_metadata"]["status"] = "failure"
@@ -24,7 +38,7 @@ class Natureserve:
             "Name Source": name_source
         }
 
-        ns_api_result = requests.get(result["processing_metadata"]["api"])
+        ns_api_result = yield result["processing_metadata"]["api"]
 
         if ns_api_result.status_code != 200:
             return None
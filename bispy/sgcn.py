@@ -1,15 +1,29 @@
-import requests
 from . import bis
+from . import transport
 
 bis_utils = bis.Utils()
 
 
 class Search:
-    def __init__(self):
+    def __init__(self, session=None):
         self.description = "Set of functions for searching the Species of Greatest Conservation Need API"
         self.sgcn_spp_search_api = "https://api.sciencebase.gov/bis-api/api/v1/swap/nationallist"
+        self.http = transport.get_transport(session)
 
+    @transport.records_cache_status
     def search(self, scientificname, name_source=None):
+        return transport.run_steps(self.http, self.search_steps(scientificname, name_source))
+
+    async def search_async(self, scientificname, name_source=None, client=None):
+        '''
+        Asyncio version of search.
+
+        :param client: optional httpx.AsyncClient to send requests through
+        :return: result structured the same as search
+        '''
+        return await transport.run_steps_async(self.http, self.search_steps(scientificname, name_source), client)
+
+    def search_steps(self, scientificname, name_source=None):
         result = bis_utils.processing_metadata()
         result["processing_metadata"]["status_message"] = "Not Matched"
         result["processing_metadata"]["status"] = "failure"
@@ -20,7 +34,7 @@ class Search:
             "Name Source": name_source
         }
 
-        r_search = requests.get(result["processing_metadata"]["api"]).json()
+        r_search = (yield result["processing_metadata"]["api"]).json()
         sgcn_species = next((i["_source"]["properties"] for i in r_search["hits"]["hits"]
                                        if i["_source"]["properties"]["scientificname"] == scientificname), None)
 
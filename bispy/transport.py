@@ -0,0 +1,622 @@
+import asyncio
+import functools
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+# Query parameters that carry credentials (e.g. the IUCN Red List API token), which are left out of cached URLs so
+# that they are not written to the cache file and do not split the cache by credential
+credential_params = {"token", "api_key", "apikey", "access_token"}
+
+# Transient HTTP errors that requests are retried on
+retry_statuses = [429, 500, 502, 503, 504]
+
+
+class ResponseCache:
+    def __init__(self, cache_path, ttl=86400, ttls=None, max_size=1024 ** 3):
+        '''
+        Persistent cache of successful (HTTP 200) GET responses keyed by URL (without any credential_params), stored
+        in a SQLite file. Entries expire after a time to live that can be set per source host, and the least recently
+        used entries are evicted when the total size of cached content goes over a cap.
+
+        :param cache_path: path to the SQLite cache file
+        :param ttl: default time to live for cached responses, in seconds
+        :param ttls: dictionary of host name (e.g. "services.itis.gov") to time to live in seconds for that source
+        :param max_size: maximum total size of cached response content, in bytes
+        '''
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.ttls = ttls or dict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                host TEXT,
+                status_code INTEGER,
+                headers TEXT,
+                encoding TEXT,
+                content BLOB,
+                size INTEGER,
+                stored REAL,
+                accessed REAL
+            );
+            CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+        ''')
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def key_for(self, url):
+        '''
+        :param url: full request URL
+        :return: URL with any credential_params removed from its query string, used to key and store the response
+        '''
+        parts = urlsplit(url)
+        if not parts.query:
+            return url
+
+        query = parse_qsl(parts.query, keep_blank_values=True)
+        kept = [(name, value) for name, value in query if name.lower() not in credential_params]
+        if len(kept) == len(query):
+            return url
+
+        return urlunsplit(parts._replace(query=urlencode(kept)))
+
+    def ttl_for(self, url):
+        return self.ttls.get(urlsplit(url).netloc, self.ttl)
+
+    def get(self, url):
+        '''
+        Looks up a cached response for a URL.
+
+        :param url: full request URL
+        :return: requests.Response with from_cache set to True, or None if the URL is not cached or has expired
+        '''
+        url = self.key_for(url)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT status_code, headers, encoding, content, size, stored FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            status_code, headers, encoding, content, size, stored = row
+            if now - stored > self.ttl_for(url):
+                self._connection.execute("DELETE FROM responses WHERE url = ?", (url,))
+                self._connection.commit()
+                self._size -= size
+                self.misses += 1
+                return None
+
+            self._connection.execute("UPDATE responses SET accessed = ? WHERE url = ?", (now, url))
+            self._connection.commit()
+            self.hits += 1
+
+        response = requests.Response()
+        response.url = url
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(json.loads(headers))
+        response.encoding = encoding
+        response._content = content
+        response.from_cache = True
+
+        return response
+
+    def put(self, url, response):
+        '''
+        Stores a response in the cache if it was successful, evicting least recently used entries as needed.
+
+        :param url: full request URL
+        :param response: requests.Response
+        '''
+        if response.status_code != 200:
+            return
+
+        url = self.key_for(url)
+
+        content = response.content
+        if len(content) > self.max_size:
+            return
+
+        now = time.time()
+        with self._lock:
+            previous = self._connection.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+            if previous is not None:
+                self._size -= previous[0]
+
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, urlsplit(url).netloc, response.status_code, json.dumps(dict(response.headers)),
+                 response.encoding, content, len(content), now, now)
+            )
+            self._size += len(content)
+
+            while self._size > self.max_size:
+                oldest = self._connection.execute(
+                    "SELECT url, size FROM responses ORDER BY accessed LIMIT 100"
+                ).fetchall()
+                for oldest_url, size in oldest:
+                    self._connection.execute("DELETE FROM responses WHERE url = ?", (oldest_url,))
+                    self._size -= size
+                    self.evictions += 1
+                    if self._size <= self.max_size:
+                        break
+
+            self._connection.commit()
+
+    def stats(self):
+        '''
+        :return: dictionary of cache hit/miss/eviction counts, hit rate, and the number and total size of entries
+        '''
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else None,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size": self._size
+        }
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+            self._size = 0
+
+
+class Transport:
+    def __init__(self, pool_size=10, max_retries=3, backoff_factor=0.5, timeout=(10, 120), session=None, cache=None):
+        '''
+        Shared HTTP transport for the bispy source modules. Requests are sent through a pooled requests.Session per
+        host so that connections are reused across calls, with retries and backoff on connection errors and
+        transient HTTP errors, and a default timeout on every request.
+
+        :param pool_size: maximum number of connections to keep open per host
+        :param max_retries: number of times to retry a request on connection errors or 429/500/502/503/504 responses
+        :param backoff_factor: backoff factor between retries (seconds, doubling with each retry)
+        :param timeout: default timeout for requests, as seconds or a (connect, read) tuple
+        :param session: requests.Session (or compatible object) to send all requests through instead of the
+        transport's own pooled sessions
+        :param cache: optional ResponseCache to answer GET requests from and store successful responses in
+        '''
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.session = session
+        self.cache = cache
+        self._sessions = dict()
+        self._lock = threading.Lock()
+        self._tracking = threading.local()
+        self._without_retries = None
+
+    def new_session(self):
+        '''
+        Creates a requests.Session with a connection pool and retry behavior set from the transport's configuration.
+
+        :return: requests.Session
+        '''
+        retry = Retry(
+            total=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=retry_statuses,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        return session
+
+    def without_retries(self):
+        '''
+        Returns a transport with the same configuration, cache and cache tracking as this one, but that does not retry
+        failed requests itself, for callers that already retry requests with their own backoff.
+
+        :return: Transport
+        '''
+        if self.max_retries == 0:
+            return self
+
+        with self._lock:
+            if self._without_retries is None:
+                http = Transport(
+                    pool_size=self.pool_size,
+                    max_retries=0,
+                    backoff_factor=self.backoff_factor,
+                    timeout=self.timeout,
+                    session=self.session,
+                    cache=self.cache
+                )
+                http._tracking = self._tracking
+                self._without_retries = http
+            return self._without_retries
+
+    def session_for(self, url):
+        '''
+        Returns the session used for requests to the host of a URL, creating it on first use.
+
+        :param url: URL to be requested
+        :return: requests.Session
+        '''
+        if self.session is not None:
+            return self.session
+
+        host = urlsplit(url).netloc
+        try:
+            return self._sessions[host]
+        except KeyError:
+            with self._lock:
+                if host not in self._sessions:
+                    self._sessions[host] = self.new_session()
+                return self._sessions[host]
+
+    def get(self, url, **kwargs):
+        '''
+        Sends a GET request through the pooled session for the URL's host, applying the default timeout unless one is
+        provided. Accepts the same keyword arguments as requests.get. If the transport has a cache, the response is
+        returned from the cache when available, and the response's from_cache attribute records which it was.
+
+        :param url: URL to request
+        :return: requests.Response
+        '''
+        kwargs.setdefault("timeout", self.timeout)
+
+        if self.cache is None:
+            return self.session_for(url).get(url, **kwargs)
+
+        cache_key = url
+        if kwargs.get("params"):
+            cache_key = requests.Request("GET", url, params=kwargs["params"]).prepare().url
+
+        response = self.cache.get(cache_key)
+        if response is None:
+            response = self.session_for(url).get(url, **kwargs)
+            response.from_cache = False
+            self.cache.put(cache_key, response)
+
+        self.record_cache_status(response.from_cache)
+
+        return response
+
+    def record_cache_status(self, from_cache):
+        '''
+        Records a response's from_cache value in the current thread's cache trackers, for responses obtained on this
+        thread's behalf in some other way (e.g. shared by a RequestCoalescer).
+
+        :param from_cache: whether the response came from the cache
+        '''
+        for tracker in getattr(self._tracking, "trackers", list()):
+            tracker.append(from_cache)
+
+    def start_cache_tracking(self):
+        '''
+        Starts recording whether each response the current thread gets through this transport came from the cache.
+
+        :return: list that the from_cache value of each response is appended to
+        '''
+        if not hasattr(self._tracking, "trackers"):
+            self._tracking.trackers = list()
+        tracker = list()
+        self._tracking.trackers.append(tracker)
+        return tracker
+
+    def stop_cache_tracking(self, tracker):
+        self._tracking.trackers.remove(tracker)
+
+    def tracked(self, function):
+        '''
+        Wraps a function to be run in another thread (e.g. submitted to a ThreadPoolExecutor) so that the responses it
+        gets are recorded in the cache trackers of the thread that wrapped it.
+
+        :param function: function to wrap
+        :return: wrapped function
+        '''
+        trackers = list(getattr(self._tracking, "trackers", list()))
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            previous = getattr(self._tracking, "trackers", list())
+            self._tracking.trackers = trackers
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._tracking.trackers = previous
+
+        return wrapper
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = dict()
+
+
+default_transport = Transport()
+
+
+def configure(**kwargs):
+    '''
+    Replaces the package-wide default transport used by source classes created afterwards without their own session.
+
+    :param kwargs: any of the Transport parameters (pool_size, max_retries, backoff_factor, timeout, session, cache)
+    :return: the new default Transport
+    '''
+    global default_transport
+    default_transport = Transport(**kwargs)
+    return default_transport
+
+
+def get_transport(session=None):
+    '''
+    Returns the transport for a source class to send its requests through.
+
+    :param session: None to use the package-wide default transport, a Transport, or a requests.Session (or compatible
+    object) to send requests through with the default timeout applied
+    :return: Transport
+    '''
+    if session is None:
+        return default_transport
+
+    if isinstance(session, Transport):
+        return session
+
+    return Transport(
+        pool_size=default_transport.pool_size,
+        max_retries=default_transport.max_retries,
+        backoff_factor=default_transport.backoff_factor,
+        timeout=default_transport.timeout,
+        session=session,
+        cache=default_transport.cache
+    )
+
+
+class RequestCoalescer:
+    def __init__(self, http):
+        '''
+        Wraps a Transport for a batch of work running in several threads so that each distinct URL is only requested
+        once. The first thread to ask for a URL sends the request and any other thread asking for the same URL waits
+        for and shares that response (or error). Responses are kept for the life of the coalescer, so it should be
+        scoped to a single batch.
+
+        :param http: Transport to send requests through
+        '''
+        self.http = http
+        self.requests_sent = 0
+        self.requests_coalesced = 0
+        self._responses = dict()
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        # Requests with extra keyword arguments (e.g. headers) are sent as they are rather than shared
+        if kwargs:
+            return self.http.get(url, **kwargs)
+
+        with self._lock:
+            response = self._responses.get(url)
+            owner = response is None
+            if owner:
+                response = self._responses[url] = Future()
+                self.requests_sent += 1
+            else:
+                self.requests_coalesced += 1
+
+        if owner:
+            try:
+                response.set_result(self.http.get(url))
+            except Exception as e:
+                response.set_exception(e)
+            return response.result()
+
+        # The owner's request was recorded in the owner thread's cache trackers, so record the shared response in
+        # this thread's as well
+        shared_response = response.result()
+        if self.http.cache is not None:
+            self.http.record_cache_status(getattr(shared_response, "from_cache", False))
+
+        return shared_response
+
+
+class HostThrottle:
+    def __init__(self, http, max_per_host=2, delay=0.5):
+        '''
+        Wraps a Transport for a batch of work running in several threads so that each host sees at most max_per_host
+        requests at a time, with at least delay seconds between the start of consecutive requests to the same host.
+
+        :param http: Transport to send requests through
+        :param max_per_host: maximum number of concurrent requests to any one host
+        :param delay: minimum number of seconds between requests to the same host
+        '''
+        self.http = http
+        self.max_per_host = max_per_host
+        self.delay = delay
+        self._hosts = dict()
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = (threading.Semaphore(self.max_per_host), threading.Lock(), [0.0])
+            slots, host_lock, last_request = self._hosts[host]
+
+        with slots:
+            with host_lock:
+                wait = last_request[0] + self.delay - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                last_request[0] = time.monotonic()
+
+            return self.http.get(url, **kwargs)
+
+
+def records_cache_status(method):
+    '''
+    Decorator for source class methods that return results with processing_metadata. When the class's transport has a
+    cache, processing_metadata gets a "from_cache" flag that is True only if every request made to produce the result
+    was answered from the cache. For methods returning a list of results (e.g. batched searches), the flag reflects all
+    of the requests made for the whole batch.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.http.cache is None:
+            return method(self, *args, **kwargs)
+
+        tracker = self.http.start_cache_tracking()
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            self.http.stop_cache_tracking(tracker)
+
+        from_cache = len(tracker) > 0 and all(tracker)
+        for r in (result if isinstance(result, list) else [result]):
+            if isinstance(r, dict) and "processing_metadata" in r:
+                r["processing_metadata"]["from_cache"] = from_cache
+
+        return result
+
+    return wrapper
+
+
+def _step_request(step):
+    # Steps yield either a URL or a (URL, keyword arguments for the request) tuple
+    if isinstance(step, tuple):
+        return step
+    return step, dict()
+
+
+def run_steps(http, steps):
+    '''
+    Runs the request steps of a search through a Transport. Search logic is written once as a generator that yields
+    each URL it needs (optionally with request keyword arguments such as headers) and receives back the response, so
+    the same parsing and packaging code is used by both the blocking and asyncio versions of a search. Errors from a
+    request are raised inside the generator at the point it yielded the URL.
+
+    :param http: Transport to send requests through
+    :param steps: generator of request steps
+    :return: the value returned by the generator
+    '''
+    try:
+        step = next(steps)
+        while True:
+            url, kwargs = _step_request(step)
+            try:
+                response = http.get(url, **kwargs)
+            except Exception as e:
+                step = steps.throw(e)
+            else:
+                step = steps.send(response)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def run_steps_async(http, steps, client=None):
+    '''
+    Asyncio version of run_steps that sends the requests through an httpx.AsyncClient. Responses are converted to
+    requests.Response objects so that the steps can handle them the same way as in the blocking version. Requests are
+    retried on transport errors and retry_statuses responses with the max_retries and backoff_factor of the
+    Transport, as its pooled sessions do. The cache of the Transport is used if it has one, in which case a from_cache
+    flag is added to the processing_metadata of the result; cache lookups and writes are run in a worker thread so
+    that they do not block the event loop.
+
+    :param http: Transport whose timeout and cache are used
+    :param steps: generator of request steps
+    :param client: httpx.AsyncClient to send requests through; a client is opened for the search if not provided
+    :return: the value returned by the generator
+    '''
+    import httpx
+
+    if client is None:
+        async with httpx.AsyncClient(timeout=http.timeout, follow_redirects=True) as client:
+            return await run_steps_async(http, steps, client)
+
+    cache_status = list()
+    try:
+        step = next(steps)
+        while True:
+            url, kwargs = _step_request(step)
+            try:
+                response = await _get_async(http, client, url, kwargs)
+            except Exception as e:
+                step = steps.throw(e)
+            else:
+                cache_status.append(response.from_cache)
+                step = steps.send(response)
+    except StopIteration as stop:
+        result = stop.value
+
+    if http.cache is not None and isinstance(result, dict) and "processing_metadata" in result:
+        result["processing_metadata"]["from_cache"] = len(cache_status) > 0 and all(cache_status)
+
+    return result
+
+
+async def _get_async(http, client, url, kwargs):
+    cache_key = url
+    if kwargs.get("params"):
+        cache_key = requests.Request("GET", url, params=kwargs["params"]).prepare().url
+
+    if http.cache is not None:
+        response = await asyncio.to_thread(http.cache.get, cache_key)
+        if response is not None:
+            return response
+
+    async_response = await _send_async(http, client, url, kwargs)
+
+    response = requests.Response()
+    response.url = str(async_response.url)
+    response.status_code = async_response.status_code
+    response.headers = CaseInsensitiveDict(async_response.headers)
+    response.encoding = async_response.encoding
+    response._content = async_response.content
+    response.from_cache = False
+
+    if http.cache is not None:
+        await asyncio.to_thread(http.cache.put, cache_key, response)
+
+    return response
+
+
+async def _send_async(http, client, url, kwargs):
+    # Follows the Retry policy of the Transport's pooled sessions: transport errors and retry_statuses responses are
+    # retried with exponential backoff (or after the Retry-After time the service gives), and the last response is
+    # returned once the retries run out
+    import httpx
+
+    max_retries = getattr(http, "max_retries", 0)
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            await asyncio.sleep(delay)
+        try:
+            async_response = await client.get(url, **kwargs)
+        except httpx.TransportError:
+            if attempt == max_retries:
+                raise
+            delay = http.backoff_factor * 2 ** attempt
+            continue
+
+        if async_response.status_code not in retry_statuses or attempt == max_retries:
+            return async_response
+
+        retry_after = async_response.headers.get("Retry-After", "")
+        delay = float(retry_after) if retry_after.isdigit() else http.backoff_factor * 2 ** attempt
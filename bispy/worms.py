@@ -1,12 +1,14 @@
-import requests
 from . import bis
+from . import transport
+import copy
 
 bis_utils = bis.Utils()
 
 class Worms:
-    def __init__(self):
+    def __init__(self, session=None):
         self.description = 'Set of functions for working with the World Register of Marine Species'
         self.filter_ranks = ["kingdom", "phylum", "class", "order", "family", "genus"]
+        self.http = transport.get_transport(session)
 
     def get_worms_search_url(self, searchType,target):
         if searchType == "ExactName":
@@ -31,7 +33,20 @@ class Worms:
         })
         return taxonomy
 
+    @transport.records_cache_status
     def search(self, scientificname, name_source=None):
+        return transport.run_steps(self.http, self.search_steps(scientificname, name_source))
+
+    async def search_async(self, scientificname, name_source=None, client=None):
+        '''
+        Asyncio version of search, including the walk through any chain of valid_AphiaID records.
+
+        :param client: optional httpx.AsyncClient to send requests through
+        :return: result structured the same as search
+        '''
+        return await transport.run_steps_async(self.http, self.search_steps(scientificname, name_source), client)
+
+    def search_steps(self, scientificname, name_source=None):
 
         headers = {'content-type': 'application/json'}
 
@@ -47,7 +62,7 @@ class Worms:
         aphiaIDs = list()
 
         url_ExactMatch = self.get_worms_search_url("ExactName", scientificname)
-        nameResults_exact = requests.get(url_ExactMatch, headers=headers)
+        nameResults_exact = yield url_ExactMatch, {"headers": headers}
 
         if nameResults_exact.status_code == 200:
             wormsDoc = nameResults_exact.json()[0]
@@ -61,7 +76,7 @@ class Worms:
         else:
             url_FuzzyMatch = self.get_worms_search_url("FuzzyName", scientificname)
             wormsResult["processing_metadata"]["api"] = url_FuzzyMatch
-            nameResults_fuzzy = requests.get(url_FuzzyMatch, headers=headers)
+            nameResults_fuzzy = yield url_FuzzyMatch, {"headers": headers}
             if nameResults_fuzzy.status_code == 200:
                 wormsDoc = nameResults_fuzzy.json()[0]
                 wormsDoc["biological_taxonomy"] = self.build_worms_taxonomy(wormsDoc)
@@ -76,7 +91,7 @@ class Worms:
             while valid_AphiaID is not None:
                 if valid_AphiaID not in aphiaIDs:
                     url_AphiaID = self.get_worms_search_url("AphiaID", valid_AphiaID)
-                    aphiaIDResults = requests.get(url_AphiaID, headers=headers)
+                    aphiaIDResults = yield url_AphiaID, {"headers": headers}
                     if aphiaIDResults.status_code == 200:
                         wormsDoc = aphiaIDResults.json()
                         # Build common biological_taxonomy structure
@@ -97,16 +112,177 @@ class Worms:
                     valid_AphiaID = None
 
         if len(wormsData) > 0:
-            # Convert to common property names for resolvable_identifier, citation_string, and date_modified
-            # from source properties
-            worms_data = list()
-            for record in wormsData:
-                record["resolvable_identifier"] = record.pop("url")
-                record["citation_string"] = record.pop("citation")
-                record["date_modified"] = record.pop("modified")
-                worms_data.append(record)
-
-            wormsResult["data"] = worms_data
+            wormsResult["data"] = self.package_worms_data(wormsData)
 
         return wormsResult
 
+    def package_worms_data(self, wormsData):
+        # Convert to common property names for resolvable_identifier, citation_string, and date_modified
+        # from source properties
+        worms_data = list()
+        for record in wormsData:
+            record["resolvable_identifier"] = record.pop("url")
+            record["citation_string"] = record.pop("citation")
+            record["date_modified"] = record.pop("modified")
+            worms_data.append(record)
+
+        return worms_data
+
+    @transport.records_cache_status
+    def search_many(self, scientificnames, name_source=None, chunk_size=50, id_chunk_size=50):
+        '''
+        Runs the same matching logic as search for a list of scientific names using the WoRMS batch services. Names
+        are matched in chunks with AphiaRecordsByNames (exact, then fuzzy for the names with no exact match), and the
+        chains of valid_AphiaID records are followed level by level, fetching all of the AphiaIDs needed at each level
+        together with AphiaRecordsByAphiaIDs. Records are kept in an AphiaID cache shared across the whole batch, so
+        each AphiaID is only requested once.
+
+        The processing_metadata details in each result carry the same single-name query URLs that search would have
+        used. If a batched name query fails, the names in that chunk are run through search individually, and if a
+        batched AphiaID query fails, those AphiaIDs are requested one at a time.
+
+        :param scientificnames: list of scientific names
+        :param name_source: name source to record in the parameters of each result
+        :param chunk_size: number of names to put into each AphiaRecordsByNames query (the service allows up to 500)
+        :param id_chunk_size: number of AphiaIDs to put into each AphiaRecordsByAphiaIDs query (the service allows up
+        to 50)
+        :return: list of results in the same order as scientificnames, each structured the same as search results
+        '''
+        unique_names = list(dict.fromkeys(scientificnames))
+        results = dict()
+        aphia_records = dict()
+
+        # Exact matches for all names, then fuzzy matches for the names we didn't find
+        matches = dict()
+        for like in [False, True]:
+            if like:
+                to_match = [n for n in unique_names if n not in results and matches.get(n) is None]
+            else:
+                to_match = unique_names
+            for i in range(0, len(to_match), chunk_size):
+                chunk = to_match[i:i + chunk_size]
+                try:
+                    chunk_records = self._batch_name_match(chunk, like)
+                except Exception:
+                    for name in chunk:
+                        results[name] = self.search(name, name_source)
+                    continue
+                for name, records in zip(chunk, chunk_records):
+                    if len(records) > 0:
+                        matches[name] = ("Fuzzy Match" if like else "Exact Match", records[0])
+                        aphia_records.setdefault(records[0]["AphiaID"], records[0])
+                    else:
+                        matches.setdefault(name, None)
+
+        # Follow the valid_AphiaID chains one level at a time for all names together
+        while True:
+            needed_ids = list(dict.fromkeys(
+                needed_id for needed_id in (
+                    self._follow_valid_aphiaids(match[1], aphia_records)[1] for match in matches.values()
+                    if match is not None
+                ) if needed_id is not None
+            ))
+            if len(needed_ids) == 0:
+                break
+            for i in range(0, len(needed_ids), id_chunk_size):
+                aphia_records.update(self._batch_aphiaid_records(needed_ids[i:i + id_chunk_size]))
+
+        for name, match in matches.items():
+            if name in results:
+                continue
+
+            wormsResult = bis_utils.processing_metadata()
+            wormsResult["processing_metadata"]["status_message"] = "Not Matched"
+            wormsResult["parameters"] = {
+                "Scientific Name": name,
+                "Name Source": name_source
+            }
+
+            if match is None:
+                wormsResult["processing_metadata"]["api"] = self.get_worms_search_url("FuzzyName", name)
+                results[name] = wormsResult
+                continue
+
+            match_type, matched_record = match
+            wormsResult["processing_metadata"]["status"] = "success"
+            wormsResult["processing_metadata"]["status_message"] = match_type
+            wormsResult["processing_metadata"]["api"] = self.get_worms_search_url(
+                "ExactName" if match_type == "Exact Match" else "FuzzyName", name
+            )
+
+            valid_records = self._follow_valid_aphiaids(matched_record, aphia_records)[0]
+            if len(valid_records) > 0:
+                wormsResult["processing_metadata"]["status_message"] = "Followed Valid AphiaID"
+                wormsResult["processing_metadata"]["api"] = self.get_worms_search_url(
+                    "AphiaID", valid_records[-1]["AphiaID"]
+                )
+
+            wormsData = list()
+            for record in [matched_record] + valid_records:
+                wormsDoc = copy.deepcopy(record)
+                wormsDoc["biological_taxonomy"] = self.build_worms_taxonomy(wormsDoc)
+                wormsData.append(wormsDoc)
+            wormsResult["data"] = self.package_worms_data(wormsData)
+
+            results[name] = wormsResult
+
+        return [copy.deepcopy(results[n]) for n in scientificnames]
+
+    def _batch_name_match(self, scientificnames, like=False):
+        # AphiaRecordsByNames returns a list of matching records for each name, or no content when nothing matched
+        params = [("scientificnames[]", n) for n in scientificnames]
+        params.extend([("like", str(like).lower()), ("marine_only", "false")])
+        response = self.http.get(
+            "http://www.marinespecies.org/rest/AphiaRecordsByNames",
+            params=params,
+            headers={'content-type': 'application/json'}
+        )
+        if response.status_code == 204:
+            return [list() for n in scientificnames]
+        response.raise_for_status()
+
+        return [records or list() for records in response.json()]
+
+    def _batch_aphiaid_records(self, aphiaids):
+        # Records for each AphiaID, with None for AphiaIDs the service could not return, so that chains stop there
+        # the same way they do in search
+        headers = {'content-type': 'application/json'}
+        aphia_records = {aphiaid: None for aphiaid in aphiaids}
+        try:
+            response = self.http.get(
+                "http://www.marinespecies.org/rest/AphiaRecordsByAphiaIDs",
+                params=[("aphiaids[]", aphiaid) for aphiaid in aphiaids],
+                headers=headers
+            )
+            if response.status_code != 204:
+                response.raise_for_status()
+                for record in response.json():
+                    if record is not None:
+                        aphia_records[record["AphiaID"]] = record
+        except Exception:
+            for aphiaid in aphiaids:
+                response = self.http.get(self.get_worms_search_url("AphiaID", aphiaid), headers=headers)
+                if response.status_code == 200:
+                    aphia_records[aphiaid] = response.json()
+
+        return aphia_records
+
+    def _follow_valid_aphiaids(self, wormsDoc, aphia_records):
+        # Walks the valid_AphiaID chain from a matched record through the records retrieved so far, returning the
+        # records followed and the next AphiaID that still needs to be retrieved (or None if the chain is complete)
+        aphiaIDs = [wormsDoc["AphiaID"]]
+        valid_records = list()
+        valid_AphiaID = wormsDoc.get("valid_AphiaID")
+        while valid_AphiaID is not None and valid_AphiaID not in aphiaIDs:
+            if valid_AphiaID not in aphia_records:
+                return valid_records, valid_AphiaID
+            record = aphia_records[valid_AphiaID]
+            if record is None:
+                break
+            valid_records.append(record)
+            if record["AphiaID"] not in aphiaIDs:
+                aphiaIDs.append(record["AphiaID"])
+            valid_AphiaID = record.get("valid_AphiaID")
+
+        return valid_records, None
+
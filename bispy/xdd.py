@@ -1,10 +1,13 @@
 from . import bis
-import requests
+from . import transport
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 bis_utils = bis.Utils()
 
 class Xdd:
-    def __init__(self, search_term=''):
+    def __init__(self, search_term='', session=None):
         self.xdd_api_base = "https://geodeepdive.org/api"
         self.search_term = search_term
         self.snippets_property_mapping = {
@@ -12,6 +15,8 @@ class Xdd:
             "URL": "document_link"
         }
         self.url = ''
+        self.cursor = None
+        self.http = transport.get_transport(session)
 
     #Supporting information to reconstruct an object
     def __repr__(self):
@@ -22,7 +27,20 @@ class Xdd:
         return f"term: {self.search_term}\n\
 url: {self.url}"
 
+    @transport.records_cache_status
     def snippets(self, search_term):
+        return transport.run_steps(self.http, self.snippets_steps(search_term))
+
+    async def snippets_async(self, search_term, client=None):
+        '''
+        Asyncio version of snippets, including paging through all results.
+
+        :param client: optional httpx.AsyncClient to send requests through
+        :return: result structured the same as snippets
+        '''
+        return await transport.run_steps_async(self.http, self.snippets_steps(search_term), client)
+
+    def snippets_steps(self, search_term):
         api_route = f"{self.xdd_api_base}/snippets?full_results&clean"
 
         xdd_result = bis_utils.processing_metadata()
@@ -33,7 +51,7 @@ url: {self.url}"
             "Search Term": search_term
         }
 
-        xdd_response = requests.get(xdd_result["processing_metadata"]["api"])
+        xdd_response = yield xdd_result["processing_metadata"]["api"]
         if xdd_response.status_code != 200:
             xdd_result["processing_metadata"]["status"] = "error"
             xdd_result["processing_metadata"]["status_message"] = f"The following status code was returned: {xdd_response.status_code}"
@@ -57,11 +75,10 @@ url: {self.url}"
             xdd_result["data"] = xdd_resultset["success"]["data"]
             search_url = xdd_resultset["success"]["next_page"]
             while len(search_url) > 0:
-                xdd_next_response = requests.get(search_url)
+                xdd_next_response = yield search_url
                 if xdd_next_response.status_code != 200:
-                    #Might want to try resending request before documenting error and moving on    
-                    #This clears Data to ensure we don't use a partial return of data here or leave what was successful?
-                    xdd_result.pop("Data", None)
+                    # Keep the pages we did get, along with the cursor to pick up the rest with iter_snippets
+                    xdd_result["processing_metadata"]["cursor"] = search_url
                     xdd_result["processing_metadata"]["status"] = "error"
                     xdd_result["processing_metadata"]["status_message"] = \
                         f"Incomplete results. While paging results the following status code was returned: " \
@@ -83,3 +100,141 @@ url: {self.url}"
                     record[v] = record.pop(k)
 
         return xdd_result
+
+    def iter_snippet_pages(self, search_term=None, cursor=None, max_retries=3, backoff_factor=1.0):
+        '''
+        Pages through snippets for a search term, yielding one page at a time so that only a single page of results is
+        held in memory. The URL of the next page to fetch is kept in the cursor attribute (and in each page's
+        next_page) so that an interrupted run can be resumed by passing it back in as cursor. A failed page request is
+        retried with exponential backoff before giving up, in place of the transport's own retries.
+
+        :param search_term: term to search for; not needed when resuming from a cursor
+        :param cursor: next_page URL to resume paging from
+        :param max_retries: number of times to retry a failed page request
+        :param backoff_factor: seconds to wait before the first retry, doubling with each further retry
+        :return: generator of dictionaries with the page url, the next_page URL (empty on the last page) and the page
+        data
+        '''
+        if cursor is None:
+            self.search_term = search_term
+            self.url = f"{self.xdd_api_base}/snippets?full_results&clean&term={search_term}"
+            cursor = self.url
+        self.cursor = cursor
+
+        while len(self.cursor) > 0:
+            xdd_page = self._get_snippet_page(self.cursor, max_retries, backoff_factor)
+            if "success" not in xdd_page:
+                raise IOError(f"No data returned from {self.cursor}. Verify request is valid.")
+
+            page = {
+                "url": self.cursor,
+                "next_page": xdd_page["success"].get("next_page") or "",
+                "data": xdd_page["success"].get("data", list())
+            }
+            self.cursor = page["next_page"]
+            yield page
+
+    def iter_snippets(self, search_term=None, cursor=None, max_retries=3, backoff_factor=1.0):
+        '''
+        Record by record version of iter_snippet_pages, with the same cursor for resuming.
+
+        :return: generator of snippet records
+        '''
+        for page in self.iter_snippet_pages(search_term, cursor, max_retries, backoff_factor):
+            yield from page["data"]
+
+    def _get_snippet_page(self, url, max_retries, backoff_factor):
+        # Retries are handled here so that they are not stacked on top of the transport's own retries
+        http = self.http.without_retries()
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                time.sleep(backoff_factor * 2 ** (attempt - 1))
+            try:
+                xdd_response = http.get(url)
+            except Exception as e:
+                error = e
+                continue
+            if xdd_response.status_code == 200:
+                return xdd_response.json()
+            error = IOError(f"The following status code was returned: {xdd_response.status_code}")
+
+        raise IOError(f"Failed to retrieve {url} after {max_retries + 1} attempts; resume from the cursor") from error
+
+    def harvest_snippets(self, search_terms, max_workers=4, max_retries=3, backoff_factor=1.0):
+        '''
+        Harvests snippets for many search terms (e.g. a species name and its synonyms) concurrently, keeping a single
+        copy of each xDD document found by any of the terms. Documents are keyed by their xDD document id (_gddid) and
+        have snippets_property_mapping applied once, while the highlights that are specific to each term are kept in
+        a term to document mapping.
+
+        :param search_terms: list of terms to search for
+        :param max_workers: maximum number of terms to page through at the same time
+        :param max_retries: number of times to retry a failed page request
+        :param backoff_factor: seconds to wait before the first retry, doubling with each further retry
+        :return: Dictionary with processing metadata and data containing the documents by _gddid and the list of
+        documents (_gddid and highlight) for each term; records without a _gddid cannot be deduplicated and are kept
+        as they are, with the term that found them, in unidentified_documents; terms that could not be fully harvested
+        are listed in processing_metadata failed_terms with the error and the cursor to resume from
+        '''
+        xdd_result = bis_utils.processing_metadata()
+        search_terms = list(dict.fromkeys(search_terms))
+        xdd_result["parameters"] = {
+            "Search Terms": search_terms
+        }
+
+        documents = dict()
+        term_documents = {term: list() for term in search_terms}
+        unidentified_documents = list()
+        failed_terms = dict()
+        lock = threading.Lock()
+
+        def harvest_term(search_term):
+            term_xdd = Xdd(session=self.http)
+            try:
+                for page in term_xdd.iter_snippet_pages(search_term, max_retries=max_retries,
+                                                        backoff_factor=backoff_factor):
+                    with lock:
+                        for record in page["data"]:
+                            gddid = record.get("_gddid")
+                            if gddid is None:
+                                record = self.map_snippet_properties(record)
+                                record["search_term"] = search_term
+                                unidentified_documents.append(record)
+                                continue
+                            term_documents[search_term].append({
+                                "_gddid": gddid,
+                                "highlight": record.pop("highlight", None)
+                            })
+                            if gddid not in documents:
+                                documents[gddid] = self.map_snippet_properties(record)
+            except Exception as e:
+                with lock:
+                    failed_terms[search_term] = {"error": str(e), "cursor": term_xdd.cursor}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(harvest_term, search_terms))
+
+        xdd_result["processing_metadata"]["status"] = "success" if len(failed_terms) == 0 else "error"
+        if len(failed_terms) > 0:
+            xdd_result["processing_metadata"]["status_message"] = f"Incomplete results for {len(failed_terms)} terms"
+            xdd_result["processing_metadata"]["failed_terms"] = failed_terms
+        xdd_result["data"] = {
+            "documents": documents,
+            "term_documents": term_documents,
+            "unidentified_documents": unidentified_documents
+        }
+
+        return xdd_result
+
+    def map_snippet_properties(self, record):
+        '''
+        Converts a snippet record to common property names using snippets_property_mapping.
+
+        :param record: snippet record
+        :return: the same record with its properties renamed
+        '''
+        for k, v in self.snippets_property_mapping.items():
+            if k in record:
+                record[v] = record.pop(k)
+
+        return record
@@ -20,4 +20,7 @@ setup(name='bispy',
             'ftfy',
             'bs4'
       ],
+      extras_require={
+            'async': ['httpx']
+      },
       zip_safe=False)
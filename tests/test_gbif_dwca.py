@@ -0,0 +1,122 @@
+import zipfile
+
+import pytest
+
+from bispy import gbif
+
+terms = ["taxonKey", "countryCode", "year", "basisOfRecord", "institutionCode", "scientificName"]
+
+rows = [
+    ["1", "100", "US", "1999", "PRESERVED_SPECIMEN", "MCZ", "Canis lupus"],
+    ["2", "100", "US", "2005", "HUMAN_OBSERVATION", "", "Canis lupus"],
+    ["3", "100", "US", "1999", "PRESERVED_SPECIMEN", "MCZ", "Canis lupus"],
+    ["4", "100", "CA", "2010", "PRESERVED_SPECIMEN", "USNM", "Canis lupus"],
+    ["5", "200", "US", "", "HUMAN_OBSERVATION", "", "Puma \"cougar\" concolor"],
+]
+
+meta_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<archive xmlns="http://rs.tdwg.org/dwc/text/" metadata="metadata.xml">
+  <core encoding="UTF-8" fieldsTerminatedBy="\\t" linesTerminatedBy="\\n" fieldsEnclosedBy="" ignoreHeaderLines="1"
+        rowType="http://rs.tdwg.org/dwc/terms/Occurrence">
+    <files><location>occurrence.txt</location></files>
+    <id index="0" />
+    <field index="0" term="http://rs.gbif.org/terms/1.0/gbifID"/>
+''' + "".join(
+    f'    <field index="{i + 1}" term="http://rs.tdwg.org/dwc/terms/{term}"/>\n' for i, term in enumerate(terms)
+) + '''    <field term="http://purl.org/dc/terms/license" default="CC0"/>
+  </core>
+</archive>'''
+
+occurrence_txt = "\t".join(["gbifID"] + terms) + "\n" + "".join("\t".join(row) + "\n" for row in rows)
+
+
+@pytest.fixture
+def dwca_path(tmp_path):
+    path = tmp_path / "dwca.zip"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("meta.xml", meta_xml)
+        archive.writestr("occurrence.txt", occurrence_txt)
+    return str(path)
+
+
+@pytest.fixture
+def simple_path(tmp_path):
+    path = tmp_path / "simple.zip"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("0001-occurrence.csv", occurrence_txt)
+    return str(path)
+
+
+def test_meta_xml_layout(dwca_path):
+    archive = gbif.DwcArchive(dwca_path)
+
+    assert archive.data_file == "occurrence.txt"
+    assert archive.delimiter == "\t"
+    assert archive.columns["id"] == 0
+    assert archive.columns["gbifID"] == 0
+    assert archive.columns["scientificName"] == 6
+    assert archive.defaults == {"license": "CC0"}
+
+
+def test_iter_rows_projects_columns(dwca_path):
+    archive = gbif.DwcArchive(dwca_path)
+
+    projected = list(archive.iter_rows(["taxonKey", "year", "license"]))
+
+    assert len(projected) == len(rows)
+    assert projected[0] == {"license": "CC0", "taxonKey": "100", "year": "1999"}
+    # Empty values come back as None, and quotes are kept as they are when fieldsEnclosedBy is empty
+    assert projected[4]["year"] is None
+    assert next(archive.iter_rows(["id"])) == {"id": "1"}
+    assert list(archive.iter_rows(["scientificName"]))[4] == {"scientificName": "Puma \"cougar\" concolor"}
+
+
+def test_iter_rows_unknown_column(dwca_path):
+    archive = gbif.DwcArchive(dwca_path)
+
+    with pytest.raises(KeyError):
+        next(archive.iter_rows(["notAColumn"]))
+
+
+def test_iter_chunks(dwca_path):
+    archive = gbif.DwcArchive(dwca_path)
+
+    chunks = list(archive.iter_chunks(["taxonKey"], chunk_size=2))
+
+    assert [len(c) for c in chunks] == [2, 2, 1]
+
+
+def test_occurrence_summaries(dwca_path):
+    archive = gbif.DwcArchive(dwca_path)
+
+    summaries = archive.occurrence_summaries(country_code="US", chunk_size=2)
+
+    assert set(summaries.keys()) == {"100", "200"}
+    assert summaries["100"]["count"] == 3
+    assert summaries["100"]["facets"] == [
+        {"field": "INSTITUTION_CODE", "counts": [{"name": "MCZ", "count": 2}]},
+        {"field": "YEAR", "counts": [{"name": "1999", "count": 2}, {"name": "2005", "count": 1}]},
+        {"field": "BASIS_OF_RECORD", "counts": [
+            {"name": "PRESERVED_SPECIMEN", "count": 2}, {"name": "HUMAN_OBSERVATION", "count": 1}
+        ]}
+    ]
+    assert summaries["200"]["count"] == 1
+
+
+def test_occurrence_summaries_all_countries(dwca_path):
+    archive = gbif.DwcArchive(dwca_path)
+
+    summaries = archive.occurrence_summaries(facets=["countryCode"], facet_limit=1)
+
+    assert summaries["100"]["count"] == 4
+    assert summaries["100"]["facets"] == [{"field": "COUNTRY_CODE", "counts": [{"name": "US", "count": 3}]}]
+
+
+def test_simple_download_without_meta_xml(simple_path, dwca_path):
+    simple = gbif.DwcArchive(simple_path)
+
+    assert simple.data_file == "0001-occurrence.csv"
+    assert simple.defaults == dict()
+    assert list(simple.iter_rows(["gbifID", "taxonKey"])) == [{"gbifID": r[0], "taxonKey": r[1]} for r in rows]
+    assert simple.occurrence_summaries(country_code="US") == \
+        gbif.DwcArchive(dwca_path).occurrence_summaries(country_code="US")
@@ -0,0 +1,35 @@
+import pytest
+
+from bispy import itis
+
+from test_itis_search_many import solr_docs
+
+
+@pytest.fixture
+def local_index(tmp_path):
+    return itis.ItisLocalIndex(str(tmp_path / "itis.sqlite"))
+
+
+def test_search_before_build(local_index):
+    assert local_index.search("Ursus arctos") == list()
+    assert local_index.search("Ursus arctos", fuzzy=True) == list()
+
+    result = itis.Itis(local_index=local_index).search("Ursus arctos")
+    assert result["processing_metadata"]["status_message"] == "Not Matched"
+
+
+def test_exact_match_is_case_sensitive(local_index):
+    local_index.build(solr_docs)
+
+    assert [d["tsn"] for d in local_index.search("Ursus arctos")] == ["100"]
+    assert [d["tsn"] for d in local_index.search("Ursus  arctos")] == ["100"]
+    assert [d["tsn"] for d in local_index.search("Ursus Arctos")] == ["101"]
+    assert local_index.search("ursus arctos") == list()
+    assert [d["tsn"] for d in local_index.search("201")] == ["201"]
+
+
+def test_fuzzy_match_ignores_case(local_index):
+    local_index.build(solr_docs)
+
+    assert [d["tsn"] for d in local_index.search("ursus arctos", fuzzy=True)] == ["101", "100"]
+    assert [d["tsn"] for d in local_index.search("Canis lupuss", fuzzy=True)] == ["200", "201"]
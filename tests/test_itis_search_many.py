@@ -0,0 +1,96 @@
+import copy
+import difflib
+import types
+
+import pytest
+
+from bispy import itis
+from bispy import transport
+
+
+def make_doc(tsn, name, usage="valid", accepted_tsn=None):
+    return {
+        "tsn": str(tsn),
+        "nameWOInd": name,
+        "nameWInd": name,
+        "usage": usage,
+        "acceptedTSN": [str(accepted_tsn if accepted_tsn is not None else tsn)],
+        "rank": "Species",
+        "createDate": "1996-06-13 14:51:08",
+        "updateDate": "2011-01-27 00:00:00",
+        "hierarchySoFarWRanks": [f"{tsn}:$Kingdom:Animalia$Genus:{name.split()[0]}$Species:{name}$"],
+        "hierarchySoFar": [f"{tsn}:$Animalia${name.split()[0]}${name}$"]
+    }
+
+
+solr_docs = [
+    make_doc(100, "Ursus arctos"),
+    make_doc(101, "Ursus Arctos", usage="invalid", accepted_tsn=100),
+    make_doc(200, "Canis lupus"),
+    make_doc(201, "Canis lupis", usage="not accepted", accepted_tsn=200)
+]
+
+
+class FakeSolrResponse:
+    def __init__(self, docs, start, rows):
+        self.status_code = 200
+        self._data = {"response": {"numFound": len(docs), "docs": copy.deepcopy(docs[start:start + rows])}}
+
+    def json(self):
+        return self._data
+
+
+def fake_solr_get(url, **kwargs):
+    '''
+    Answers ITIS Solr queries the way the string name fields do: exact matches are case sensitive and fuzzy
+    matches are approximate.
+    '''
+    params = dict(p.split("=", 1) for p in url.split("?", 1)[1].split("&"))
+    docs = list()
+    for doc in solr_docs:
+        for term in params["q"].split("%20OR%20"):
+            field, value = term.split(":", 1)
+            fuzzy = value.endswith("~0.8")
+            value = value.replace("~0.8", "").replace("\\%20", " ")
+            if field not in doc:
+                continue
+            if fuzzy:
+                matched = difflib.SequenceMatcher(None, doc[field].lower(), value.lower()).ratio() >= 0.85
+            else:
+                matched = doc[field] == value
+            if matched:
+                docs.append(doc)
+                break
+
+    return FakeSolrResponse(docs, int(params.get("start", 0)), int(params["rows"]))
+
+
+@pytest.fixture
+def itis_search():
+    http = transport.Transport(session=types.SimpleNamespace(get=fake_solr_get))
+    return itis.Itis(session=http, tsn_cache=itis.TsnCache())
+
+
+def strip_date(result):
+    result = copy.deepcopy(result)
+    result["processing_metadata"].pop("date_processed")
+    return result
+
+
+def test_search_many_matches_search_for_case_and_spelling_variants(itis_search):
+    names = ["Ursus arctos", "ursus arctos", "Ursus Arctos", "Ursus  arctos", "Canis lupus", "Canis lupis",
+             "Canis lupuss", "200"]
+
+    expected = [strip_date(itis_search.search(n)) for n in names]
+    itis_search.tsn_cache.clear()
+    batched = [strip_date(r) for r in itis_search.search_many(names, chunk_size=len(names))]
+
+    assert batched == expected
+
+
+def test_search_many_case_variant_falls_back_to_fuzzy(itis_search):
+    results = itis_search.search_many(["Ursus arctos", "ursus arctos"])
+
+    assert results[0]["processing_metadata"]["status_message"] == "Exact Match"
+    assert [d["tsn"] for d in results[0]["data"]] == ["100"]
+    assert results[1]["processing_metadata"]["status_message"] == "Fuzzy Match"